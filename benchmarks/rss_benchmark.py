@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks the content pipeline of the rss plugin against synthetic feeds served by a local HTTP server.
+
+Each channel gets its own generated feed, whose entries link to generated article pages. The channels are refreshed
+concurrently for a number of rounds, a part of the entries of each feed being replaced between the rounds, and the
+throughput, latencies, lock wait and peak memory of the refreshes are reported. The caches of the plugin are kept in
+a temporary directory, so that the benchmark neither uses nor modifies those of an actual deployment.
+
+Example: python3 benchmarks/rss_benchmark.py --channels 16 --rounds 5 --entries 50 --rules 6 --page-size 65536
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import urlparse
+
+
+class FeedServer(object):
+    """ Serves the generated feeds and article pages, honouring the If-None-Match validators of the requests. """
+    def __init__(self, entries, page_size, churn, feed_format):
+        self.entries = entries
+        self.page_size = page_size
+        self.churn = churn
+        self.feed_format = feed_format
+        self.generation = 0  # Incremented between the rounds to replace a part of the entries
+        self.requests = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                path = urlparse(self.path).path.strip('/').split('/')
+                if len(path) == 2 and path[0] == 'feed':
+                    body, content_type, max_age = server.get_feed(path[1]), 'application/xml', 0
+                elif len(path) == 3 and path[0] == 'article':
+                    body, content_type, max_age = server.get_article(path[1], path[2]), 'text/html', 300
+                else:
+                    self.send_error(404)
+                    return
+                etag = '"%s"' % hashlib.md5(body).hexdigest()
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', 'max-age=%d' % max_age)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base_url = 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def get_entry_ids(self, feed_id):
+        changed = int(self.entries * self.churn)
+        return ['%s-%d-%d' % (feed_id, self.generation if i < changed else 0, i) for i in range(self.entries)]
+
+    def get_feed(self, feed_id):
+        items = []
+        for i, entry_id in enumerate(self.get_entry_ids(feed_id)):
+            link = '%s/article/%s/%s' % (self.base_url, feed_id, entry_id)
+            summary = 'Summary of entry %s. ' % entry_id * 8
+            if self.feed_format == 'atom':
+                items.append('<entry><id>%s</id><title>Entry %s</title><link href="%s"/><summary>%s</summary>'
+                             '<updated>%s</updated></entry>' % (link, entry_id, link, summary,
+                                                                time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())))
+            else:
+                items.append('<item><guid>%s</guid><title>Entry %s</title><link>%s</link><description>%s</description>'
+                             '<pubDate>%s</pubDate></item>' % (link, entry_id, link, summary, formatdate()))
+        if self.feed_format == 'atom':
+            feed = '<?xml version="1.0"?><feed xmlns="http://www.w3.org/2005/Atom"><title>Feed %s</title>%s</feed>'
+        else:
+            feed = '<?xml version="1.0"?><rss version="2.0"><channel><title>Feed %s</title>%s</channel></rss>'
+        return (feed % (feed_id, ''.join(items))).encode()
+
+    def get_article(self, feed_id, entry_id):
+        paragraph = '<p>Article %s of feed %s, lorem ipsum dolor sit amet.</p>\n' % (entry_id, feed_id)
+        filler = paragraph * (self.page_size // len(paragraph) + 1)
+        return ('<html><head><title>Article %s</title></head><body><img src="/images/%s.jpg"/>%s</body></html>'
+                % (entry_id, entry_id, filler[:self.page_size])).encode()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class BenchmarkChannel(object):
+    """ A lightweight stand-in for the Channel model, only providing what the rss plugin uses. """
+    def __init__(self, id, params):
+        self.id = id
+        self.name = 'benchmark-%d' % id
+        self.params = params
+
+    def get_config_param(self, param):
+        return self.params[param]
+
+
+def get_parser_rules(count, link_pages):
+    """ Returns count parser rules, a part of them extracting content from the article pages if requested. """
+    rules = ['title-1:text;title;^Entry (?P<this>.*)$', 'text-1:text;summary;(?P<this>[^.]*)\\.']
+    if link_pages:
+        rules.append('image-1:src;link_page;<img src="(?P<this>[^"]+)"')
+    i = 0
+    while len(rules) < count:
+        i += 1
+        if link_pages and i % 2 == 0:
+            rules.append('text-%d:text;link_page;<p>(?P<this>Article [^<]*?%d[^<]*)</p>' % (i + 1, i))
+        else:
+            rules.append('text-%d:text;summary;(?P<this>[^.]*%d[^.]*)\\.' % (i + 1, i))
+    return rules[:count]
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run_benchmark(args):
+    from ictv.plugins.rss import rss, timing  # Imported once main has redirected the caches
+    server = FeedServer(args.entries, args.page_size, args.churn, args.format)
+    parser_rules = get_parser_rules(args.rules, not args.no_link_pages)
+    channels = {}
+    for i in range(1, args.channels + 1):
+        channels[i] = BenchmarkChannel(i, {
+            'url': '%s/feed/%d' % (server.base_url, i), 'parser_rules': parser_rules,
+            'additional_rules': ['logo-1:src;qrcode'], 'filter': False, 'exception_rules': [''],
+            'no_slides': args.entries, 'time_limit': 7, 'duration': 10, 'template': 'template-image-bg',
+            'theme': 'ictv'})
+
+    lock_waits = []
+    stages = {}
+    stages_lock = threading.Lock()
+
+    def collect_timings(channel_id, channel_stages, channel_rules):
+        with stages_lock:
+            lock_waits.append(channel_stages.get('lock wait', 0))
+            for name, duration in channel_stages.items():
+                stages[name] = stages.get(name, 0) + duration
+    timing.add_metrics_hook(collect_timings)
+
+    latencies = []
+    capsules = 0
+
+    def refresh(channel_id):
+        start = time.perf_counter()
+        content = rss.get_content(channel_id)
+        return time.perf_counter() - start, len(content)
+
+    if args.trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with mock.patch.object(rss.Channel, 'get', side_effect=channels.__getitem__), \
+            mock.patch.object(rss, 'get_entry_retention', return_value=timedelta(days=rss.entry_retention)), \
+            ThreadPoolExecutor(max_workers=args.channels) as executor:
+        for round in range(args.rounds):
+            server.generation = round
+            if args.cold:
+                rss._last_content.clear()
+            for latency, count in executor.map(refresh, channels):
+                latencies.append(latency)
+                capsules += count
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    results = {
+        'refreshes': len(latencies),
+        'capsules': capsules,
+        'requests': server.requests,
+        'elapsed': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p99': percentile(latencies, 99),
+        'latency_max': max(latencies),
+        'lock_wait_total': sum(lock_waits),
+        'lock_wait_p99': percentile(lock_waits, 99),
+        'stages': {k: v / len(latencies) for k, v in sorted(stages.items(), key=lambda x: x[1], reverse=True)},
+        'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,  # ru_maxrss is in KiB on Linux
+    }
+    if args.trace_memory:
+        results['traced_memory_peak'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return results
+
+
+def print_results(results):
+    print('%d refreshes (%d capsules, %d HTTP requests) in %.3fs' % (results['refreshes'], results['capsules'],
+                                                                      results['requests'], results['elapsed']))
+    print('Throughput:  %.1f refreshes/s' % results['throughput'])
+    print('Latency:     p50 %.1fms, p99 %.1fms, max %.1fms' % (results['latency_p50'] * 1000,
+                                                              results['latency_p99'] * 1000,
+                                                              results['latency_max'] * 1000))
+    print('Lock wait:   total %.1fms, p99 %.1fms' % (results['lock_wait_total'] * 1000,
+                                                     results['lock_wait_p99'] * 1000))
+    print('Memory:      max RSS %.1f MiB' % (results['max_rss'] / 2 ** 20), end='')
+    if 'traced_memory_peak' in results:
+        print(', traced peak %.1f MiB' % (results['traced_memory_peak'] / 2 ** 20), end='')
+    print()
+    print('Mean time per refresh and stage:')
+    for name, duration in results['stages'].items():
+        print('  %-22s %8.2fms' % (name, duration * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the rss plugin against synthetic local feeds.')
+    parser.add_argument('--channels', type=int, default=8, help='number of channels refreshed concurrently')
+    parser.add_argument('--rounds', type=int, default=3, help='number of refreshes of each channel')
+    parser.add_argument('--entries', type=int, default=20, help='number of entries of each feed')
+    parser.add_argument('--rules', type=int, default=4, help='number of parser rules of each channel')
+    parser.add_argument('--page-size', type=int, default=32 * 1024, help='size of the article pages, in bytes')
+    parser.add_argument('--churn', type=float, default=0.25, help='fraction of the entries replaced at each round')
+    parser.add_argument('--format', choices=['rss', 'atom'], default='rss', help='format of the feeds')
+    parser.add_argument('--no-link-pages', action='store_true', help='do not use rules extracting from the articles')
+    parser.add_argument('--cold', action='store_true', help='forget the content built at the previous round')
+    parser.add_argument('--trace-memory', action='store_true', help='measure the peak memory using tracemalloc')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    cache_dir = tempfile.mkdtemp(prefix='ictv-rss-benchmark-')
+    os.environ['ICTV_RSS_CACHE_DIR'] = cache_dir  # Read when the plugin is imported by run_benchmark
+    try:
+        results = run_benchmark(args)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    main()
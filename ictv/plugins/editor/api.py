@@ -107,10 +107,9 @@ class APIIndex(EditorAPIPage):
             resp.badrequest()
 
         try:
-            c = EditorCapsule(name=post_data['name'], theme=post_data['theme'], validity_from=validity_from, validity_to=validity_to, channel=channel, c_order=EditorCapsule.selectBy(channel=channel).count())
+            c = EditorCapsule(name=post_data['name'], theme=post_data['theme'], validity_from=validity_from, validity_to=validity_to, channel=channel, c_order=EditorCapsule.get_next_c_order(channel.id))
         except DuplicateEntryError:
             resp.badrequest()
-        EditorCapsule.rectify_c_order(channel.id)
         response = resp.created()
         response.headers['Location'] = '/channels/{}/api/capsules/{}'.format(channel.id, c.id)
         return response
@@ -181,11 +180,10 @@ class APIIndexSlides(EditorAPIPage):
         if {'duration', 'template', 'content'} != set(post_data.keys()):
             resp.badrequest()
         try:
-            s = EditorSlide(s_order=c.slides.count(), capsule=c, **post_data)
+            s = EditorSlide(s_order=EditorSlide.get_next_s_order(c.id), capsule=c, **post_data)
         except SQLObjectIntegrityError:
             resp.badrequest()
 
-        EditorSlide.rectify_s_order(c.id)
         response = resp.created()
         response.header['Location'] = '/channels/{}/api/capsules/{}/slides/{}'.format(channel.id, capsule_id, s.id)
         return response
@@ -43,8 +43,10 @@ from ictv.plugin_manager.plugin_capsule import PluginCapsule
 from ictv.plugin_manager.plugin_manager import PluginManager
 from ictv.plugin_manager.plugin_utils import ChannelGate, seeother
 from ictv.plugins.editor.editor import EditorSlide, EditorCapsule, AssetSlideMapping
+from ictv.plugins.editor.pdf_import import get_import_job
 from ictv.renderer.renderer import SlideRenderer, Themes, Templates
 
+import flask
 import ictv
 from ictv.common.utils import get_methods
 import ictv.flask.response as resp
@@ -281,7 +283,7 @@ class Index(EditorPage):
         except SQLObjectNotFound:
             return 'there is no capsule with id ' + capsuleid
         s = EditorSlide(duration=-1, content=content,
-                        s_order=EditorSlide.selectBy(capsule=capsuleid).count(), template=template, capsule=capsuleid)
+                        s_order=EditorSlide.get_next_s_order(capsuleid), template=template, capsule=capsuleid)
         list(capsule.slides).append(s)
         for asset in assets:
             mapping = AssetSlideMapping(assetID=asset.id, slideID=s.id)
@@ -444,6 +446,18 @@ class LocalSlideRender(EditorPage):  # TODO: This is not secure
 
         return slide_defaults
 
+class PDFImportProgress(EditorPage):
+    @ChannelGate.contributor
+    def get(self, job_id, channel):
+        job = get_import_job(job_id)
+        if job is None or job.channel_id != channel.id:
+            resp.notfound()
+        response = flask.Response(json.dumps({'progress': job.progress, 'pages': job.pages, 'done': job.done,
+                                              'error': job.error}))
+        response.headers['Content-Type'] = 'application/json'
+        return response
+
+
 from ictv.plugins.editor import capsules_page, slides_page, rendering_pages, api
 
 def init_mapping(subapp):
@@ -464,6 +478,7 @@ def init_mapping(subapp):
     subapp.add_url_rule('/api/capsules/<int:capsule_id>', view_func=ictv.plugins.editor.api.APICapsules.as_view('APICapsules'), methods=get_methods(ictv.plugins.editor.api.APICapsules))
     subapp.add_url_rule('/api/capsules/<int:capsule_id>/slides', view_func=ictv.plugins.editor.api.APIIndexSlides.as_view('APIIndexSlides'), methods=get_methods(ictv.plugins.editor.api.APIIndexSlides))
     subapp.add_url_rule('/api/capsules/<int:capsule_id>/slides/<int:slide_id>', view_func=ictv.plugins.editor.api.APISlides.as_view('APISlides'), methods=get_methods(ictv.plugins.editor.api.APISlides))
+    subapp.add_url_rule('/import/<string:job_id>/progress', view_func=ictv.plugins.editor.app.PDFImportProgress.as_view('PDFImportProgress'), methods=get_methods(ictv.plugins.editor.app.PDFImportProgress))
     subapp.add_url_rule('/api/templates', view_func=ictv.plugins.editor.api.APITemplates.as_view('APITemplates'), methods=get_methods(ictv.plugins.editor.api.APITemplates))
 
 
@@ -26,15 +26,14 @@ from json import JSONDecodeError
 from pymediainfo import MediaInfo
 from sqlobject import SQLObjectNotFound
 from sqlobject.dberrors import DuplicateEntryError
-from wand.color import Color
-from wand.image import Image
 
 from ictv.app import sidebar
 from ictv.common.feedbacks import add_feedback, ImmediateFeedback, store_form
 from ictv.plugin_manager.plugin_manager import get_logger
 from ictv.plugin_manager.plugin_utils import ChannelGate, VideoSlide
 from ictv.plugins.editor.app import EditorPage
-from ictv.plugins.editor.editor import EditorCapsule, EditorSlide, AssetSlideMapping
+from ictv.plugins.editor.editor import EditorCapsule, EditorSlide
+from ictv.plugins.editor.pdf_import import import_pdf
 from ictv.storage.storage_manager import StorageManager
 
 import flask
@@ -95,26 +94,19 @@ class CapsulesPage(EditorPage):
                     return "you seem to try to change the order of slides that doesn't exist..."
                 except JSONDecodeError:
                     return "invalid changes"
-                capsules_to_reorder = {}
-                for k in new_order.keys():
-                    try:
-                        capsule = EditorCapsule.get(int(k))
-                        capsules_to_reorder[k] = capsule
-                        if capsule.channel.id != channel.id:
-                            return "you try to change the order of a capsule in a different channel..."
-                    except SQLObjectNotFound:
-                        return "You try to change the order of slides that doesn't exist..."
-                sorted_list = sorted(capsules_to_reorder.values(), key=lambda caps: caps.c_order)
-                new_to_old_order = {}
-                i = 0
-                for elem in sorted_list:
-                    new_to_old_order[i] = elem.c_order
-                    i += 1
                 try:
-                    for k, v in new_order.items():
-                        capsules_to_reorder[k].c_order = new_to_old_order[int(v)]
-                except ValueError:
+                    new_order = {int(k): int(v) for k, v in new_order.items()}
+                except (AttributeError, ValueError):
                     return "invalid changes"
+                channel_capsules = {c.id for c in EditorCapsule.selectBy(channel=channel.id)}
+                for capsule_id in new_order:
+                    if capsule_id not in channel_capsules:
+                        try:
+                            EditorCapsule.get(capsule_id)
+                            return "you try to change the order of a capsule in a different channel..."
+                        except SQLObjectNotFound:
+                            return "You try to change the order of slides that doesn't exist..."
+                EditorCapsule.reorder(channel.id, sorted(new_order, key=new_order.get))
                 capsules = EditorCapsule.rectify_c_order(channel.id)
 
             elif form['action'] == 'create' or form['action'].startswith('import'):
@@ -140,7 +132,7 @@ class CapsulesPage(EditorPage):
                         raise ImmediateFeedback(form.action, 'dates_inverted')
                     capsule = EditorCapsule(name=form['name'], channel=channel, ownerID=self.session['user']['id'],
                                             creation_date=datetime.datetime.now(),
-                                            c_order=EditorCapsule.select().count(),
+                                            c_order=EditorCapsule.get_next_c_order(channel.id),
                                             validity_from=date_from,
                                             validity_to=date_to)
                     if form.action.startswith('import'):
@@ -148,31 +140,10 @@ class CapsulesPage(EditorPage):
                         background_color = 'white' if 'white-background' in form and form['white-background'] == 'on' else 'black'
 
                         if form.action == 'import-capsule' and 'pdf' in form:
-
-                            slide_files = []
-                            try:
-                                with Color(background_color) as bg:
-                                    with Image(blob=form.pdf.read(), resolution=150) as pdf:
-                                        for i, page in enumerate(pdf.sequence):
-                                            img_page = Image(image=page)
-                                            img_page.background_color = bg
-                                            img_page.alpha_channel = False
-                                            img_page.format = 'jpeg'
-                                            img_page.transform(resize='1920x1080>')
-                                            slide_files.append(storage_manager.store_file(img_page.make_blob('jpeg'),
-                                                                                          filename='import-capsule-%d-slide-%d.jpeg' % (capsule.id, i),
-                                                                                          user=self.session['user']['id']))
-                                slide_duration = channel.get_config_param('duration') * 1000
-                                for i, slide_file in enumerate(slide_files):
-                                    s = EditorSlide(duration=slide_duration,
-                                                    content={'background-1': {'file': slide_file.id,
-                                                                              'size': 'contain',
-                                                                              'color': background_color}},
-                                                    s_order=i, template='template-image-bg', capsule=capsule)
-                                    AssetSlideMapping(assetID=slide_file.id, slideID=s.id)
-                            except (ValueError, TypeError):
-                                logger.warning('An Exception has been encountered when importing PDF file:',
-                                               extra=logger_extra, exc_info=True)
+                            job = import_pdf(form.pdf, capsule, storage_manager, self.session['user']['id'],
+                                             background_color, channel.get_config_param('duration') * 1000, logger,
+                                             logger_extra)
+                            raise ImmediateFeedback(form.action, 'pdf_importing', job.id)
                         elif form.action == 'import-video' and 'video' in form:
                             try:
                                 video_slide = EditorSlide.from_video(form.video, storage_manager, self.transcoding_queue, capsule, self.session['user']['id'], background_color)
@@ -224,7 +195,7 @@ class CapsulesPage(EditorPage):
     def render_page(self, channel, capsules=None):
         now = datetime.datetime.now()
         if capsules is None:
-            capsules_all = EditorCapsule.selectBy(channel=channel.id)
+            capsules_all = EditorCapsule.selectBy(channel=channel.id).orderBy(['c_order', 'id'])
             capsules = capsules_all.filter(EditorCapsule.q.validity_to > now)
             expired_capsules = capsules_all.filter(EditorCapsule.q.validity_to <= now)
         else:
@@ -19,11 +19,17 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
+import copy
+import hashlib
 import ipaddress
+import json
 import os
 import socket
+import threading
 from base64 import b64encode
-from datetime import datetime
+from collections import namedtuple
+from datetime import datetime, timedelta
 from urllib.parse import urlparse
 
 import magic
@@ -32,7 +38,11 @@ from sqlobject import AND, JSONCol, sqlhub
 from sqlobject import IntCol, StringCol, ForeignKey, DateTimeCol, SQLMultipleJoin, DatabaseIndex, \
     SQLObject
 from sqlobject.dberrors import DuplicateEntryError
-from sqlobject.events import listen, RowDestroyedSignal
+from sqlobject.dbconnection import Transaction
+from sqlobject.main import SQLObjectNotFound
+from sqlobject.sqlbuilder import Select, LEFTJOINOn
+from sqlobject.events import listen, RowCreatedSignal, RowUpdateSignal, RowUpdatedSignal, RowDestroySignal, \
+    RowDestroyedSignal
 from typing import Iterable
 
 from ictv.models.asset import Asset
@@ -44,26 +54,210 @@ from ictv.plugin_manager.plugin_slide import PluginSlide
 from ictv.plugin_manager.plugin_utils import SQLObjectAndABCMeta, VideoSlide, MisconfiguredParameters
 from ictv.storage.cache_manager import CacheManager
 
+mime_sniff_size = 8 * 1024  # in bytes, the MIME type of an uploaded video is detected from its first bytes
+upload_chunk_size = 1024 * 1024  # in bytes, the uploaded videos are written to disk by chunks
+content_max_age = 10 * 60  # in seconds, the cached content of a channel is rebuilt at least this often, so that
+                          # the changes made to the database without SQLObject are eventually seen
+
+CachedContent = namedtuple('CachedContent', ['params', 'changes', 'signature', 'capsules', 'version', 'expires'])
+
+_content_cache = {}  # Maps the id of each channel to its CachedContent
+_content_cache_lock = threading.Lock()
+
+
 def get_content(channelid, capsuleid=None) -> Iterable[PluginCapsule]:
-    content = []
     channel = PluginChannel.get(channelid)
     if 0 < len(channel.get_config_param('api_key') or '') < 8:
         raise MisconfiguredParameters('api_key', channel.get_config_param('api_key'), "The key must be at least 8-character long")
+    force_duration = channel.get_config_param('force_duration')
+    default_duration = int(channel.get_config_param('duration') * 1000)
     if capsuleid is None:
-        now = datetime.now()
-        capsules = EditorCapsule.selectBy(channel=channelid).filter(
-            AND(EditorCapsule.q.validity_to > now, EditorCapsule.q.validity_from < now)).orderBy("c_order")
-        for c in capsules:
-            content.append(c.to_plugin_capsule())
-    else:
-        content = [EditorCapsule.get(capsuleid).to_plugin_capsule()]
-    for capsule in content:
-        for slide in capsule.get_slides():
-            if channel.get_config_param('force_duration') or slide.duration == -1:
-                slide.duration = int(channel.get_config_param('duration') * 1000)
+        # The capsules are copied as the callers modify them, e.g. when dereferencing their assets
+        return copy.deepcopy(get_cached_content(channelid, force_duration, default_duration).capsules)
+    content = EditorCapsule.to_plugin_capsules(EditorCapsule.q.id == capsuleid, force_duration, default_duration)
+    if not content:
+        raise SQLObjectNotFound('The EditorCapsule %r does not exist' % capsuleid)
     return content
 
 
+def get_content_version(channelid) -> int:
+    """
+    Returns the version of the content of the channel. It increases each time the content changes, so that it can be
+    used as an ETag and rendering a channel whose version did not change can be skipped. It is stored in the
+    database, so that all the processes serving the channel agree on it.
+    """
+    channel = PluginChannel.get(channelid)
+    return get_cached_content(channelid, channel.get_config_param('force_duration'),
+                              int(channel.get_config_param('duration') * 1000)).version
+
+
+def get_cached_content(channel_id, force_duration, default_duration):
+    """
+    Returns the CachedContent of the active capsules of the channel. It is rebuilt when the capsules, slides or assets
+    of the channel change in any process, when one of its capsules becomes active or expires and when its parameters
+    change.
+    """
+    now = datetime.now()
+    params = (force_duration, default_duration)
+    changes, version, digest = get_content_state(channel_id)
+    with _content_cache_lock:
+        cached = _content_cache.get(channel_id)
+    if cached is not None and cached.params == params and cached.changes == changes and now < cached.expires:
+        return cached
+
+    capsules = EditorCapsule.to_plugin_capsules(AND(EditorCapsule.q.channel == channel_id,
+                                                    EditorCapsule.q.validity_to > now,
+                                                    EditorCapsule.q.validity_from < now),
+                                                force_duration, default_duration)
+    signature = [(c.theme, [(s.template, s.duration, s.content) for s in c.slides]) for c in capsules]
+    new_digest = hashlib.sha256(json.dumps([params, signature], sort_keys=True).encode()).hexdigest()
+    if new_digest != digest:
+        version = bump_content_version(channel_id, new_digest)
+    expires = now + timedelta(seconds=content_max_age)
+    next_validity_change = EditorCapsule.get_next_validity_change(channel_id, now)
+    if next_validity_change is not None:
+        expires = min(expires, next_validity_change)
+    cached = CachedContent(params, changes, signature, capsules, version, expires)
+    with _content_cache_lock:
+        _content_cache[channel_id] = cached
+    return cached
+
+
+def get_content_state(channel_id):
+    """
+    Returns the number of changes of the content of the channel, its version and the digest of the content that
+    version was given to, as stored in its EditorContentVersion.
+    """
+    connection = EditorContentVersion._connection
+    query = connection.sqlrepr(Select([EditorContentVersion.q.changes, EditorContentVersion.q.version,
+                                       EditorContentVersion.q.digest], where=EditorContentVersion.q.channel == channel_id))
+    state = connection.queryOne(query)
+    if state is None:
+        try:
+            EditorContentVersion(channelID=channel_id)
+        except DuplicateEntryError:
+            pass  # Created by another process meanwhile
+        state = connection.queryOne(query)
+    return state
+
+
+def bump_content_version(channel_id, digest):
+    """ Increments the version of the content of the channel, given to the content with the given digest. """
+    connection = EditorContentVersion._connection
+    table = EditorContentVersion.sqlmeta.table
+    channel_column = EditorContentVersion.sqlmeta.columns['channelID'].dbName
+    connection.query('UPDATE %s SET version = version + 1, digest = %s WHERE %s = %d' % (
+        table, connection.sqlrepr(digest), channel_column, channel_id))
+    return connection.queryOne(connection.sqlrepr(Select([EditorContentVersion.q.version],
+                                                         where=EditorContentVersion.q.channel == channel_id)))[0]
+
+
+def invalidate_content(channel_id=None):
+    """
+    Expires the cached content of the given channel, or of all the channels if it is not given, in all the processes.
+    The content is rebuilt at their next request, and its version is preserved if the rebuilt content is identical.
+    """
+    connection = EditorContentVersion._connection
+    query = 'UPDATE %s SET changes = changes + 1' % EditorContentVersion.sqlmeta.table
+    if channel_id is not None:
+        query += ' WHERE %s = %d' % (EditorContentVersion.sqlmeta.columns['channelID'].dbName, channel_id)
+    connection.query(query)
+
+
+def on_content_changed(instance, *args):
+    """ Invalidates the cached content of the channel of the capsule, slide or asset mapping being changed. """
+    if isinstance(instance._connection, Transaction):
+        return  # The content is invalidated once the transaction is committed, see create_slides
+    try:
+        if isinstance(instance, AssetSlideMapping):
+            instance = EditorSlide.get(instance.slideID)
+        if isinstance(instance, EditorSlide):
+            instance = EditorCapsule.get(instance.capsuleID)
+        invalidate_content(instance.channelID)
+    except SQLObjectNotFound:
+        invalidate_content()  # E.g. when the capsule is being destroyed along with its slides
+
+
+order_gap = 1024  # The c_order and s_order keys are spaced by this gap, so that an item can be moved or inserted
+                  # between two others by only updating its own key
+
+
+def get_new_orders(orders, target, moved=()):
+    """
+    Returns a dict mapping the ids of the items that must be updated to their new order key, so that the items are
+    in the target order. orders maps the id of each item to its current key. The items that are already in order,
+    i.e. the longest increasing subsequence of their keys in the target order, keep their keys and the others are
+    given keys between their neighbours. The items of moved are never kept in place. When there is no room left
+    between two neighbours, all the items are spaced again by order_gap.
+    """
+    # Finds the longest strictly increasing subsequence of keys, in O(n log n)
+    tails, tail_indices, previous = [], [], {}
+    for i, item_id in enumerate(target):
+        if item_id in moved:
+            continue
+        position = bisect.bisect_left(tails, orders[item_id])
+        previous[i] = tail_indices[position - 1] if position > 0 else None
+        if position == len(tails):
+            tails.append(orders[item_id])
+            tail_indices.append(i)
+        else:
+            tails[position] = orders[item_id]
+            tail_indices[position] = i
+    kept = set()
+    i = tail_indices[-1] if tail_indices else None
+    while i is not None:
+        kept.add(i)
+        i = previous[i]
+
+    new_orders = {}
+    lower = None
+    run = []
+    for i, item_id in enumerate(target + [None]):
+        if i < len(target) and i not in kept:
+            run.append(item_id)
+            continue
+        upper = orders[item_id] if item_id is not None else None
+        if run:
+            if lower is None and upper is None:
+                lower, upper = -order_gap, order_gap * len(run)
+            elif lower is None:
+                lower = upper - order_gap * (len(run) + 1)
+            elif upper is None:
+                upper = lower + order_gap * (len(run) + 1)
+            if upper - lower <= len(run):
+                return {item_id: i * order_gap for i, item_id in enumerate(target)
+                        if orders[item_id] != i * order_gap or item_id in moved}
+            for j, run_id in enumerate(run):
+                new_orders[run_id] = lower + (upper - lower) * (j + 1) // (len(run) + 1)
+            run = []
+        lower = upper
+    return new_orders
+
+
+def update_orders(cls, column, new_orders):
+    """ Sets the order keys of the given rows in a single transaction, with one UPDATE statement per 500 rows. """
+    if not new_orders:
+        return
+    connection = cls._connection
+    transaction = connection.transaction()
+    try:
+        items = sorted(new_orders.items())
+        for i in range(0, len(items), 500):
+            chunk = items[i:i + 500]
+            transaction.query('UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+                cls.sqlmeta.table, cls.sqlmeta.columns[column].dbName, cls.sqlmeta.idName,
+                ' '.join('WHEN %d THEN %d' % (item_id, order) for item_id, order in chunk),
+                cls.sqlmeta.idName, ', '.join(str(item_id) for item_id, _ in chunk)))
+        transaction.commit(close=True)
+    except Exception:
+        transaction.rollback()
+        raise
+    for item_id in new_orders:
+        instance = connection.cache.tryGet(item_id, cls)
+        if instance is not None:
+            instance.expire()  # The rows were updated behind SQLObject
+
+
 class EditorPluginCapsule(PluginCapsule):
     def __init__(self, theme=None):
         self.theme = theme
@@ -109,6 +303,55 @@ def on_mapping_deleted(instance, kwargs):
 listen(on_mapping_deleted, AssetSlideMapping, RowDestroyedSignal)
 
 
+class EditorContentVersion(SQLObject):
+    """
+    The version of the content of a channel, shared by all the processes serving it. changes is incremented at each
+    change of the capsules, slides or assets of the channel, version each time the content built differs from the one
+    whose digest is stored.
+    """
+    channel = ForeignKey('PluginChannel', cascade=True)
+    changes = IntCol(notNone=True, default=0)
+    version = IntCol(notNone=True, default=0)
+    digest = StringCol(length=64, default=None)
+    channel_index = DatabaseIndex('channel', unique=True)
+
+
+class VideoDigest(SQLObject):
+    """ Maps the SHA-256 digest of a video uploaded to a channel to the WebM asset it was converted to. """
+    digest = StringCol(length=64, notNone=True)
+    asset = ForeignKey('Asset', cascade=True)
+    channel = ForeignKey('PluginChannel', cascade=True)
+    digest_index = DatabaseIndex('digest', 'channel', unique=True)
+
+
+def store_upload(upload, storage_manager, user):
+    """
+    Writes the uploaded file to a new asset by chunks, detecting its MIME type from its first bytes and hashing its
+    content meanwhile. Returns the asset and the SHA-256 hex digest of its content.
+    """
+    chunk = upload.read(mime_sniff_size)
+    asset = storage_manager.create_asset(filename=upload.filename, user=user,
+                                         mime_type=magic.from_buffer(chunk, mime=True))
+    digest = hashlib.sha256()
+    size = 0
+    os.makedirs(os.path.dirname(asset.path), exist_ok=True)
+    with open(asset.path, 'wb') as f:
+        while chunk:
+            f.write(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+            chunk = upload.read(upload_chunk_size)
+    asset.file_size = size
+    return asset, digest.hexdigest()
+
+
+def record_video_digest(digest, asset_id, channel_id):
+    try:
+        VideoDigest(digest=digest, assetID=asset_id, channelID=channel_id)
+    except DuplicateEntryError:
+        pass  # The same video was uploaded and converted concurrently
+
+
 class EditorSlide(SQLObject, PluginSlide, metaclass=SQLObjectAndABCMeta):
     duration = IntCol(notNone=True)
     content = JSONCol(notNone=True, default={})
@@ -139,40 +382,67 @@ class EditorSlide(SQLObject, PluginSlide, metaclass=SQLObjectAndABCMeta):
             capsule.insert_slide_at(video_slide, capsule.slides.count())
             return video_slide
 
-        # TODO: Stream asset to disk instead of loading it into memory
-        video_blob = video.read()
-        if magic.from_buffer(video_blob, mime=True) != 'video/webm':
+        original_video_asset, digest = store_upload(video, storage_manager, user)
+        channel_id = capsule.channel.id
+        known_video = VideoDigest.selectBy(digest=digest, channelID=channel_id).getOne(None)
+        if known_video is not None:
+            if os.path.exists(known_video.asset.path):  # This video was already uploaded and converted
+                original_video_asset.destroySelf()
+                return create_slide(known_video.asset.id, capsule.id)
+            known_video.destroySelf()
+
+        if original_video_asset.mime_type != 'video/webm':
             def transcode_callback(success_status):
                 if success_status:
                     create_slide(video_asset_id, capsule_id)
                     video_asset.file_size = os.path.getsize(video_asset.path)
+                    record_video_digest(digest, video_asset_id, channel_id)
                 else:
                     video_asset.destroySelf()
                 original_video_asset.destroySelf()
 
-            original_video_asset = storage_manager.store_file(video_blob, filename=video.filename, user=user)
             video_asset = storage_manager.create_asset(filename=video.filename + os.extsep + '.webm', user=user, mime_type='video/webm')
             video_asset_id, capsule_id = video_asset.id, capsule.id
             transcoding_manager.enqueue_task(original_video_asset.path, video_asset.path, transcode_callback)
             return video_asset.path
         else:
-            video_asset = storage_manager.store_file(video_blob, filename=video.filename, user=user)
-            return create_slide(video_asset.id, capsule.id)
+            record_video_digest(digest, original_video_asset.id, channel_id)
+            return create_slide(original_video_asset.id, capsule.id)
 
     def _init(self, id, connection=None, selectResults=None):
         return super()._init(id, connection, selectResults)
 
     @classmethod
     def rectify_s_order(cls, capsule_id):
-        slide_list = list(EditorSlide.select(EditorSlide.q.capsule == capsule_id, orderBy=EditorSlide.q.s_order))
-        if len(slide_list) > 0 and slide_list[0].s_order == 0 and slide_list[-1].s_order == len(slide_list) - 1:
-            return slide_list
-        i = 0
-        for s in slide_list:
-            s.s_order = i
-            i += 1
+        """ Returns the slides of the capsule in their order, first separating the slides that share an order key. """
+        slide_list = list(EditorSlide.select(EditorSlide.q.capsule == capsule_id, orderBy=['s_order', 'id']))
+        if any(a.s_order == b.s_order for a, b in zip(slide_list, slide_list[1:])):
+            EditorSlide.reorder(capsule_id, [s.id for s in slide_list])
         return slide_list
 
+    @classmethod
+    def get_next_s_order(cls, capsule_id):
+        """ Returns the order key of a slide appended to the capsule. """
+        last = EditorSlide.selectBy(capsuleID=capsule_id).max('s_order')
+        return last + order_gap if last is not None else 0
+
+    @classmethod
+    def reorder(cls, capsule_id, slide_ids, moved=()):
+        """
+        Orders the given slides of the capsule as in the given list, only updating the order keys of the slides that
+        moved. The other slides of the capsule keep their place.
+        """
+        connection = cls._connection
+        orders = dict(connection.queryAll(connection.sqlrepr(
+            Select([cls.q.id, cls.q.s_order], where=cls.q.capsule == capsule_id, orderBy=[cls.q.s_order, cls.q.id]))))
+        slots = set(slide_ids)
+        replacement = iter(slide_ids)
+        target = [next(replacement) if slide_id in slots else slide_id for slide_id in orders]
+        new_orders = get_new_orders(orders, target, moved)
+        update_orders(cls, 's_order', new_orders)
+        if new_orders:
+            invalidate_content(EditorCapsule.get(capsule_id).channelID)
+
     def to_plugin_slide(self) -> EditorPluginSlide:
         return EditorPluginSlide(content=self.content, template=self.template, duration=int(self.duration))
 
@@ -240,31 +510,49 @@ class EditorCapsule(SQLObject, PluginCapsule, metaclass=SQLObjectAndABCMeta):
 
     @classmethod
     def rectify_c_order(cls, channel_id):
-        capsules_list = list(
-            EditorCapsule.select(EditorCapsule.q.channel == channel_id, orderBy=EditorCapsule.q.c_order))
-        if len(capsules_list) > 0 and capsules_list[0].c_order == 0 and capsules_list[-1].c_order == len(
-                capsules_list) - 1:
-            return EditorCapsule.select(EditorCapsule.q.channel == channel_id, orderBy=EditorCapsule.q.c_order)
-        i = 0
-        for c in capsules_list:
-            c.c_order = i
-            i += 1
-        return EditorCapsule.select(EditorCapsule.q.channel == channel_id, orderBy=EditorCapsule.q.c_order)
+        """
+        Returns the capsules of the channel in their order, first separating the capsules that share an order key,
+        e.g. a duplicated capsule and its original.
+        """
+        capsules = EditorCapsule.select(EditorCapsule.q.channel == channel_id, orderBy=['c_order', 'id'])
+        capsules_list = list(capsules)
+        if any(a.c_order == b.c_order for a, b in zip(capsules_list, capsules_list[1:])):
+            EditorCapsule.reorder(channel_id, [c.id for c in capsules_list])
+        return capsules
+
+    @classmethod
+    def get_next_c_order(cls, channel_id):
+        """ Returns the order key of a capsule appended to the channel. """
+        last = EditorCapsule.selectBy(channelID=channel_id).max('c_order')
+        return last + order_gap if last is not None else 0
+
+    @classmethod
+    def reorder(cls, channel_id, capsule_ids):
+        """
+        Orders the given capsules of the channel as in the given list, only updating the order keys of the capsules
+        that moved. The other capsules of the channel, e.g. the expired ones, keep their place.
+        """
+        connection = cls._connection
+        orders = dict(connection.queryAll(connection.sqlrepr(
+            Select([cls.q.id, cls.q.c_order], where=cls.q.channel == channel_id, orderBy=[cls.q.c_order, cls.q.id]))))
+        slots = set(capsule_ids)
+        replacement = iter(capsule_ids)
+        target = [next(replacement) if capsule_id in slots else capsule_id for capsule_id in orders]
+        new_orders = get_new_orders(orders, target)
+        update_orders(cls, 'c_order', new_orders)
+        if new_orders:
+            invalidate_content(channel_id)
 
     def insert_slide_at(self, slide, index):
         """
-        inserts the slide at the correct position of the slides list of the capsule, updating the s_order of the
-        slides located after the index position in the list.
+        inserts the slide at the given position of the slides list of the capsule. Only the s_order of this slide is
+        updated, unless there is no room left between the slides surrounding this position.
         """
-        # get the slides of the capsule, ordered by their s_order
-        slides = list(EditorSlide.select(EditorSlide.q.capsule == self.id, orderBy=EditorSlide.q.s_order))
-        # set the s_order of the new slide
-        slide.s_order = index
         slide.capsule = self.id
-        # update the s_order of all the slides with a s_order >= the s_order of this slide
-        for i in range(index, len(slides)):
-            slides[i].s_order += 1
-        EditorSlide.rectify_s_order(self.id)
+        slide_ids = [s.id for s in EditorSlide.select(AND(EditorSlide.q.capsule == self.id, EditorSlide.q.id != slide.id),
+                                                      orderBy=['s_order', 'id'])]
+        slide_ids.insert(min(index, len(slide_ids)), slide.id)
+        EditorSlide.reorder(self.id, slide_ids, moved={slide.id})
 
     def to_plugin_capsule(self) -> EditorPluginCapsule:
         caps = EditorPluginCapsule(theme=self.theme)
@@ -272,6 +560,45 @@ class EditorCapsule(SQLObject, PluginCapsule, metaclass=SQLObjectAndABCMeta):
             caps.add_slide(s.to_plugin_slide())
         return caps
 
+    @classmethod
+    def get_next_validity_change(cls, channel_id, now):
+        """ Returns the next time at which a capsule of the channel becomes active or expires, or None. """
+        changes = []
+        for column in ('validity_from', 'validity_to'):
+            capsule = list(cls.select(AND(cls.q.channel == channel_id, getattr(cls.q, column) > now))
+                           .orderBy(column).limit(1))
+            if capsule:
+                changes.append(getattr(capsule[0], column))
+        return min(changes) if changes else None
+
+    @classmethod
+    def to_plugin_capsules(cls, where, force_duration=False, default_duration=None):
+        """
+        Returns the EditorPluginCapsule of each capsule matching the given clause, in the order of the channel, using
+        a single query joining the capsules with their slides. If a default duration is given, it replaces the
+        duration of the slides that have none, or of all of them if force_duration is set.
+        """
+        connection = cls._connection
+        query = Select([cls.q.id, cls.q.theme, EditorSlide.q.id, EditorSlide.q.content, EditorSlide.q.template,
+                        EditorSlide.q.duration], where=where,
+                       join=LEFTJOINOn(cls, EditorSlide, EditorSlide.q.capsule == cls.q.id),
+                       orderBy=[cls.q.c_order, cls.q.id, EditorSlide.q.s_order])
+        content_column = EditorSlide.sqlmeta.columns['content']
+        capsules = []
+        capsule_id = None
+        for c_id, theme, s_id, content, template, duration in connection.queryAll(connection.sqlrepr(query)):
+            if c_id != capsule_id:
+                capsule_id = c_id
+                capsules.append(EditorPluginCapsule(theme=theme))
+            if s_id is None:
+                continue  # A capsule without any slide
+            duration = int(duration)
+            if default_duration is not None and (force_duration or duration == -1):
+                duration = default_duration
+            capsules[-1].add_slide(EditorPluginSlide(content=content_column.to_python(content, None),
+                                                     template=template, duration=duration))
+        return capsules
+
     def get_slides(self) -> Iterable[PluginSlide]:
         return self.slides
 
@@ -304,7 +631,7 @@ class EditorCapsule(SQLObject, PluginCapsule, metaclass=SQLObjectAndABCMeta):
 
         duplicate = create_capsule(str(self.name))
         for slide in self.slides:
-            EditorSlide.from_slide(slide=slide, capsule=duplicate)
+            EditorSlide.from_slide(slide=slide, capsule=duplicate, slide_order=slide.s_order)
         return duplicate
 
     def to_json_api(self):
@@ -317,15 +644,33 @@ class EditorCapsule(SQLObject, PluginCapsule, metaclass=SQLObjectAndABCMeta):
         }
 
 
+for model in (EditorCapsule, EditorSlide, AssetSlideMapping):
+    for signal in (RowCreatedSignal, RowUpdateSignal, RowUpdatedSignal, RowDestroySignal, RowDestroyedSignal):
+        listen(on_content_changed, model, signal)
+
+
 def install():
     EditorCapsule.createTable(ifNotExists=True)
     EditorSlide.createTable(ifNotExists=True)
     AssetSlideMapping.createTable(ifNotExists=True)
+    VideoDigest.createTable(ifNotExists=True)
+    EditorContentVersion.createTable(ifNotExists=True)
     Plugin.selectBy(name='editor').getOne().version = 0
 
 
 def update(plugin):
     if plugin.version < 1:
-        # Do the update
-        # plugin.version = 1
-        pass
+        # Spaces the order keys of the capsules and slides by order_gap
+        for channel in PluginChannel.selectBy(plugin=plugin):
+            capsules = list(EditorCapsule.select(EditorCapsule.q.channel == channel.id, orderBy=['c_order', 'id']))
+            update_orders(EditorCapsule, 'c_order', {c.id: i * order_gap for i, c in enumerate(capsules)})
+            for capsule in capsules:
+                slides = EditorSlide.select(EditorSlide.q.capsule == capsule.id, orderBy=['s_order', 'id'])
+                update_orders(EditorSlide, 's_order', {s.id: i * order_gap for i, s in enumerate(slides)})
+        plugin.version = 1
+    if plugin.version < 2:
+        VideoDigest.createTable(ifNotExists=True)
+        plugin.version = 2
+    if plugin.version < 3:
+        EditorContentVersion.createTable(ifNotExists=True)
+        plugin.version = 3
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from wand.color import Color
+from wand.image import Image
+
+from ictv.plugins.editor.editor import EditorCapsule, EditorSlide, AssetSlideMapping, invalidate_content, order_gap
+
+resolution = 150  # in dpi, the resolution at which the pages are rasterized
+job_retention = 60 * 60  # in seconds, the progress of an import can be retrieved during this period after its update
+chunk_size = 1024 * 1024  # in bytes, the uploaded file is copied to disk by chunks
+jobs_dir = os.path.join(os.path.dirname(__file__), 'cache', 'import_jobs')  # Shared by the processes serving the editor
+os.makedirs(jobs_dir, exist_ok=True)
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='editor-pdf-import')
+
+
+class ImportJob(object):
+    """
+    The progress of the import of a PDF file into a capsule, as followed by the capsule and slides pages. It is stored
+    on disk, so that it can be followed from any of the processes serving the editor.
+    """
+    def __init__(self, capsule_id, channel_id, id=None, pages=None, done=0, error=False, finish_time=None):
+        self.id = id if id is not None else uuid.uuid4().hex
+        self.capsule_id = capsule_id
+        self.channel_id = channel_id
+        self.pages = pages
+        self.done = done
+        self.error = error
+        self.finish_time = finish_time
+
+    def to_json(self):
+        return {'id': self.id, 'capsule_id': self.capsule_id, 'channel_id': self.channel_id, 'pages': self.pages,
+                'done': self.done, 'error': self.error, 'finish_time': self.finish_time}
+
+    @classmethod
+    def from_json(cls, d):
+        return cls(d['capsule_id'], d['channel_id'], d['id'], d['pages'], d['done'], d['error'], d['finish_time'])
+
+    @property
+    def finished(self):
+        return self.finish_time is not None
+
+    @property
+    def progress(self):
+        if self.finished:
+            return 1
+        return self.done / self.pages if self.pages else 0
+
+
+def import_pdf(pdf, capsule, storage_manager, user_id, background_color, slide_duration, logger, logger_extra):
+    """
+    Copies the uploaded PDF file to disk and converts each of its pages to a slide appended to the capsule in the
+    background. Returns the ImportJob following its progress.
+    """
+    with tempfile.NamedTemporaryFile(prefix='ictv-pdf-import-', suffix='.pdf', delete=False) as f:
+        shutil.copyfileobj(pdf, f, chunk_size)
+    job = ImportJob(capsule.id, capsule.channel.id)
+    store_import_job(job)
+    now = time.time()
+    for filename in os.listdir(jobs_dir):
+        try:
+            if now - os.path.getmtime(os.path.join(jobs_dir, filename)) > job_retention:
+                os.remove(os.path.join(jobs_dir, filename))
+        except OSError:  # Removed by another process
+            pass
+    _executor.submit(run_import, job, f.name, storage_manager, user_id, background_color, slide_duration, logger,
+                     logger_extra)
+    return job
+
+
+def get_import_job(job_id):
+    """ Returns the ImportJob with the given id, or None if it does not exist. """
+    if not re.fullmatch('[0-9a-f]{32}', job_id):
+        return None
+    try:
+        with open(os.path.join(jobs_dir, job_id + '.json'), 'r') as f:
+            return ImportJob.from_json(json.load(f))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def store_import_job(job):
+    path = os.path.join(jobs_dir, job.id + '.json')
+    tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'w') as f:
+        json.dump(job.to_json(), f)
+    os.replace(tmp_path, path)
+
+
+def run_import(job, path, storage_manager, user_id, background_color, slide_duration, logger, logger_extra):
+    """
+    Rasterizes the pages of the PDF file one at a time, so that only one of them is held in memory, stores them as
+    assets and then creates all the slides at once.
+    """
+    assets = []
+    try:
+        with Image.ping(filename=path) as pdf:
+            job.pages = len(pdf.sequence)
+        store_import_job(job)
+        with Color(background_color) as bg:
+            for i in range(job.pages):
+                with Image(filename='%s[%d]' % (path, i), resolution=resolution) as page:
+                    page.background_color = bg
+                    page.alpha_channel = False
+                    page.format = 'jpeg'
+                    page.transform(resize='1920x1080>')
+                    assets.append(storage_manager.store_file(page.make_blob('jpeg'),
+                                                             filename='import-capsule-%d-slide-%d.jpeg' % (job.capsule_id, i),
+                                                             user=user_id))
+                job.done = i + 1
+                store_import_job(job)
+        create_slides(job.capsule_id, assets, background_color, slide_duration)
+    except Exception:
+        logger.warning('An Exception has been encountered when importing PDF file:', extra=logger_extra, exc_info=True)
+        job.error = True
+        for asset in assets:
+            asset.destroySelf()
+    finally:
+        job.finish_time = time.time()
+        store_import_job(job)
+        os.remove(path)
+
+
+def create_slides(capsule_id, assets, background_color, slide_duration):
+    """ Appends a slide showing each of the given image assets to the capsule, in a single transaction. """
+    offset = EditorSlide.get_next_s_order(capsule_id)
+    transaction = EditorSlide._connection.transaction()
+    try:
+        for i, asset in enumerate(assets):
+            s = EditorSlide(duration=slide_duration,
+                            content={'background-1': {'file': asset.id, 'size': 'contain', 'color': background_color}},
+                            s_order=offset + i * order_gap, template='template-image-bg', capsule=capsule_id,
+                            connection=transaction)
+            AssetSlideMapping(assetID=asset.id, slideID=s.id, connection=transaction)
+        transaction.commit(close=True)
+    except Exception:
+        transaction.rollback()
+        raise
+    invalidate_content(EditorCapsule.get(capsule_id).channelID)  # The slides might have been read before the commit
@@ -21,6 +21,8 @@
 
 from datetime import datetime
 
+from sqlobject import AND
+
 from ictv.plugin_manager.plugin_manager import PluginManager
 from ictv.plugin_manager.plugin_utils import ChannelGate
 from ictv.plugins.editor.app import EditorPage
@@ -30,11 +32,8 @@ from ictv.plugins.editor.editor import EditorCapsule
 class RenderExpired(EditorPage):
     @ChannelGate.contributor
     def get(self, channel):
-        capsules = EditorCapsule.selectBy(channel=channel).filter(
-            EditorCapsule.q.validity_to <= datetime.now()).orderBy('c_order')
-        list_to_render = []
-        for c in capsules:
-            list_to_render.append(c.to_plugin_capsule())
+        list_to_render = EditorCapsule.to_plugin_capsules(
+            AND(EditorCapsule.q.channel == channel.id, EditorCapsule.q.validity_to <= datetime.now()))
         PluginManager.dereference_assets(list_to_render)
         return self.ictv_renderer.preview_capsules(list_to_render)
 
@@ -42,10 +41,7 @@ class RenderExpired(EditorPage):
 class RenderCurrentAndFuture(EditorPage):
     @ChannelGate.contributor
     def get(self, channel):
-        capsules = EditorCapsule.selectBy(channel=channel).filter(
-            EditorCapsule.q.validity_to > datetime.now()).orderBy('c_order')
-        list_to_render = []
-        for c in capsules:
-            list_to_render.append(c.to_plugin_capsule())
+        list_to_render = EditorCapsule.to_plugin_capsules(
+            AND(EditorCapsule.q.channel == channel.id, EditorCapsule.q.validity_to > datetime.now()))
         PluginManager.dereference_assets(list_to_render)
         return self.ictv_renderer.preview_capsules(list_to_render)
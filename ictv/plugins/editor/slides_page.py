@@ -23,17 +23,16 @@ import datetime
 import json
 from json import JSONDecodeError
 
-from sqlobject import SQLObjectNotFound
+from sqlobject import AND, SQLObjectNotFound
 from sqlobject.dberrors import DuplicateEntryError
-from wand.color import Color
-from wand.image import Image
 
 from ictv.app import sidebar
 from ictv.common.feedbacks import add_feedback, ImmediateFeedback, store_form
 from ictv.plugin_manager.plugin_manager import get_logger
 from ictv.plugin_manager.plugin_utils import ChannelGate, seeother
 from ictv.plugins.editor.app import EditorPage
-from ictv.plugins.editor.editor import EditorCapsule, EditorSlide, AssetSlideMapping
+from ictv.plugins.editor.editor import EditorCapsule, EditorSlide
+from ictv.plugins.editor.pdf_import import import_pdf
 from ictv.renderer.renderer import Themes
 from ictv.storage.storage_manager import StorageManager
 
@@ -82,8 +81,9 @@ class SlidesPage(EditorPage):
                 except SQLObjectNotFound:
                     return "there is no slide with the id " + form.id + " in the channel " + str(channel.id)
                 duplicate = slide.duplicate(s_order=-1)
-                caps_db.insert_slide_at(duplicate, slide.s_order + 1)
-                slides = caps_db.slides
+                index = EditorSlide.select(AND(EditorSlide.q.capsule == caps_db.id, EditorSlide.q.id != duplicate.id,
+                                               EditorSlide.q.s_order <= slide.s_order)).count()
+                caps_db.insert_slide_at(duplicate, index)
             elif form.action == 'order':
                 try:
                     new_order = json.loads(form.order)
@@ -91,16 +91,19 @@ class SlidesPage(EditorPage):
                     return "you seem to try to change the order of slides that doesn't exist..."
                 except JSONDecodeError:
                     return "invalid changes"
-                for k, v in new_order.items():
-                    try:
-                        slide = EditorSlide.get(int(k))
-                        if slide.capsule.id != int(capsuleid):
+                try:
+                    new_order = {int(k): int(v) for k, v in new_order.items()}
+                except (AttributeError, ValueError):
+                    return "invalid changes"
+                capsule_slides = {s.id for s in slides}
+                for slide_id in new_order:
+                    if slide_id not in capsule_slides:
+                        try:
+                            EditorSlide.get(slide_id)
                             return "you try to change the order of a slide in a different capsule..."
-                        slide.s_order = int(v)
-                    except ValueError:
-                        return "invalid changes"
-                    except SQLObjectNotFound:
-                        return "You try to change the order of slides that doesn't exist..."
+                        except SQLObjectNotFound:
+                            return "You try to change the order of slides that doesn't exist..."
+                EditorSlide.reorder(caps_db.id, sorted(new_order, key=new_order.get))
                 slides = EditorSlide.rectify_s_order(capsuleid)
             elif form.action == 'theme':
                 caps_db = EditorCapsule.get(int(capsuleid))
@@ -135,36 +138,11 @@ class SlidesPage(EditorPage):
                 storage_manager = StorageManager(channel.id)
                 capsule = caps_db
                 background_color = 'white' if 'white-background' in form and form['white-background'] == 'on' else 'black'
-                offset = EditorSlide.selectBy(capsule=capsule).max('s_order')
-                offset = offset + 1 if offset is not None else 0
 
                 if form.action == 'import-slides' and 'pdf' in form:
-                    slide_files = []
-                    try:
-                        with Color(background_color) as bg:
-                            with Image(blob=form.pdf.read(), resolution=150) as pdf:
-                                for i, page in enumerate(pdf.sequence):
-                                    img_page = Image(image=page)
-                                    img_page.background_color = bg
-                                    img_page.alpha_channel = False
-                                    img_page.format = 'jpeg'
-                                    img_page.transform(resize='1920x1080>')
-                                    asset = storage_manager.store_file(img_page.make_blob('jpeg'),
-                                                                       filename='import-capsule-%d-slide-%d.jpeg' % (capsule.id, offset + i),
-                                                                       user=self.session['user']['id'])
-                                    slide_files.append(asset)
-                        slide_duration = channel.get_config_param('duration') * 1000
-                        for i, slide_file in enumerate(slide_files):
-                            s = EditorSlide(duration=slide_duration,
-                                            content={'background-1': {'file': slide_file.id,
-                                                                      'size': 'contain',
-                                                                      'color': background_color}},
-                                            s_order=offset + i, template='template-image-bg', capsule=capsule)
-
-                            AssetSlideMapping(assetID=slide_file.id, slideID=s.id)
-                    except (ValueError, TypeError):
-                        logger.warning('An Exception has been encountered when importing PDF file:', extra=logger_extra,
-                                       exc_info=True)
+                    job = import_pdf(form.pdf, capsule, storage_manager, self.session['user']['id'], background_color,
+                                     channel.get_config_param('duration') * 1000, logger, logger_extra)
+                    raise ImmediateFeedback(form.action, 'pdf_importing', job.id)
                 elif form.action == 'import-video' and 'video' in form:
                     try:
                         video_slide = EditorSlide.from_video(form.video, storage_manager, self.transcoding_queue, capsule, self.session['user']['id'], background_color)
@@ -196,7 +174,7 @@ class SlidesPage(EditorPage):
             return "there is no capsule with the id " + str(capsuleid) + " in the channel " + str(channel.id)
         except ImmediateFeedback:
             store_form(form)
-        return self.render_page(channel=channel, capsule=caps_db, slides=caps_db.slides)
+        return self.render_page(channel=channel, capsule=caps_db, slides=caps_db.slides.orderBy(['s_order', 'id']))
 
     @sidebar
     def render_page(self, channel, capsule, slides):
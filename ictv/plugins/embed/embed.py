@@ -21,9 +21,12 @@
 
 import hashlib
 import os
+import threading
+from contextlib import contextmanager
 
 import time
 import urllib
+from concurrent.futures import ThreadPoolExecutor
 from urllib.error import URLError
 
 import ictv.plugin_manager.plugin_manager
@@ -33,11 +36,30 @@ from ictv.plugin_manager.plugin_capsule import PluginCapsule
 from ictv.plugin_manager.plugin_slide import PluginSlide
 from ictv.plugin_manager.plugin_utils import MisconfiguredParameters
 from ictv.plugins.embed.inliner import inline
+from ictv.plugins.embed.resource_cache import cache_dir, write_file
+
+try:
+    import fcntl
+except ImportError:  # The rebuilds are then only exclusive within a process
+    fcntl = None
 
 static_dir = os.path.join(os.path.dirname(__file__), 'static')
 if not os.path.exists(static_dir):
     os.mkdir(static_dir)
 
+refresh_jitter = 0.1  # Each cache expires up to 10% of its refresh rate earlier, so that the channels spread their rebuilds
+
+_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='embed-refresh')
+_pending_refreshes = set()  # The file hashes of the caches being rebuilt in the background
+_pending_refreshes_lock = threading.Lock()
+
+assets_page = 'plugins/embed/assets'  # The images of the pages using sidecar assets, named after their content
+
+locks_dir = os.path.join(cache_dir, 'locks')
+os.makedirs(locks_dir, exist_ok=True)
+_rebuild_locks = {}  # file hash -> threading.Lock serializing the rebuilds of this cache within the process
+_rebuild_locks_lock = threading.Lock()
+
 
 def get_content(channel_id):
     channel = PluginChannel.get(channel_id)
@@ -54,23 +76,104 @@ def get_content(channel_id):
         return []
 
     iframe_path, full_iframe_path, inlined_page, full_inlined_page_path = get_paths(file_hash)
+    scripts, inline_options = get_inline_params(channel)
 
-    if not os.path.exists(full_iframe_path) or os.path.getmtime(full_iframe_path) + (refresh_rate * 60 * 60) < int(time.time()):
-        logger.debug('Rebuilding cache', extra=logger_extra)
-        # No cache exists or it has expired
-        scripts = []
-        if channel.get_config_param('jquery'):
-            scripts.append('/static/plugins/embed/js/jquery.min.js')
-        if channel.get_config_param('jquery_ui'):
-            scripts.append('/static/plugins/embed/js/jquery-ui.min.js')
+    built_time = get_mtime(full_inlined_page_path)
+    if built_time is None:
+        logger.debug('Building cache', extra=logger_extra)
         try:
-            inline(link, full_inlined_page_path, logger, scripts)
+            rebuild_cache(link, scripts, inline_options, file_hash, logger, built_time)
         except URLError as e:
             raise MisconfiguredParameters('link', link, 'The following error was encountered: %s.' % str(e))
-        iframe_path = create_iframe_page('/static/' + inlined_page, width, height, file_hash)
+    elif get_expiration_time(built_time, refresh_rate, file_hash) < int(time.time()):
+        # The cache has expired, it is still served while being rebuilt in the background
+        schedule_refresh(link, scripts, inline_options, file_hash, logger, logger_extra, built_time)
+    iframe_path = create_iframe_page('/static/' + inlined_page, width, height, file_hash)
     return [EmbedCapsule(iframe_path, duration * 1000)]
 
 
+def get_inline_params(channel):
+    """ Returns the scripts to add to the inlined page of the channel and the options of the inliner. """
+    scripts = []
+    if channel.get_config_param('jquery'):
+        scripts.append('/static/plugins/embed/js/jquery.min.js')
+    if channel.get_config_param('jquery_ui'):
+        scripts.append('/static/plugins/embed/js/jquery-ui.min.js')
+    inline_options = {'deduplicate': channel.get_config_param('deduplicate_resources')}
+    if channel.get_config_param('sidecar_assets'):
+        inline_options['assets_dir'] = os.path.join(get_root_path(), 'static', assets_page)
+        inline_options['assets_url'] = '/static/' + assets_page
+        os.makedirs(inline_options['assets_dir'], exist_ok=True)
+    return scripts, inline_options
+
+
+def rebuild_cache(link, scripts, inline_options, file_hash, logger, built_time):
+    """
+    Inlines the page at the given link, unless the cache was rebuilt by another thread or process since it was
+    found to be built at the given time. Only one rebuild of a given cache takes place at a time.
+    """
+    _, _, _, full_inlined_page_path = get_paths(file_hash)
+    with rebuild_lock(file_hash):
+        if get_mtime(full_inlined_page_path) != built_time:
+            return  # The rebuild was done while waiting for the lock
+        inline(link, full_inlined_page_path, logger, scripts, **inline_options)
+
+
+@contextmanager
+def rebuild_lock(file_hash):
+    """ Acquires the lock of the given cache, both among the threads of this process and among the processes. """
+    with _rebuild_locks_lock:
+        lock = _rebuild_locks.setdefault(file_hash, threading.Lock())
+    with lock:
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(locks_dir, file_hash + '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def schedule_refresh(link, scripts, inline_options, file_hash, logger, logger_extra, built_time):
+    """ Rebuilds the given cache in the background, unless it is already being rebuilt. """
+    with _pending_refreshes_lock:
+        if file_hash in _pending_refreshes:
+            return
+        _pending_refreshes.add(file_hash)
+
+    def refresh():
+        try:
+            logger.debug('Rebuilding cache', extra=logger_extra)
+            rebuild_cache(link, scripts, inline_options, file_hash, logger, built_time)
+        except Exception as e:
+            logger.warning('Failed to rebuild the cache of %s, the previous one is kept: %s' % (link, str(e)),
+                           extra=logger_extra)
+        finally:
+            with _pending_refreshes_lock:
+                _pending_refreshes.discard(file_hash)
+
+    _refresh_executor.submit(refresh)
+
+
+def get_expiration_time(mtime, refresh_rate, file_hash):
+    """
+    Returns the time at which the cache built at the given time expires. The jitter is derived from the file hash, so
+    that it is stable for a given channel but differs between the channels having the same refresh rate.
+    """
+    refresh_interval = refresh_rate * 60 * 60
+    jitter = refresh_interval * refresh_jitter * int(file_hash[:8], 16) / 0xffffffff
+    return mtime + refresh_interval - jitter
+
+
 def create_iframe_page(src, width, height, file_hash):
     html = """<html>
             <head>
@@ -108,8 +211,14 @@ def create_iframe_page(src, width, height, file_hash):
             </body>
             </html>""".format(src, width, height)
     iframe_page = 'plugins/embed/iframe_' + file_hash + '.html'
-    with open(os.path.join(get_root_path(), 'static', iframe_page), 'w') as f:
-        f.write(html)
+    full_iframe_path = os.path.join(get_root_path(), 'static', iframe_page)
+    try:
+        with open(full_iframe_path, 'r') as f:
+            if f.read() == html:
+                return iframe_page  # The page is only rewritten when its source or dimensions change
+    except OSError:
+        pass
+    write_file(full_iframe_path, html.encode())
     return iframe_page
 
 
@@ -124,6 +233,8 @@ def invalidate_cache(channel_id):
 
     safe_rm(full_iframe_path)
     safe_rm(full_inlined_page_path)
+    safe_rm(full_inlined_page_path + '.gz')
+    safe_rm(full_inlined_page_path + '.br')
 
 
 def get_file_hash(channel_id, link):
@@ -22,16 +22,59 @@
 #    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
 
 import base64
+import gzip
+import hashlib
 import mimetypes
+import os
 import re
+import time
 import urllib
 import sys
-from bs4 import BeautifulSoup
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
+import lxml.html
 
-def inline(url, output_filename, logger, scripts=None):
+from ictv.plugins.embed.resource_cache import fetch_resource, write_file, ResourceSkipped
+
+try:
+    import brotli
+except ImportError:  # The pages are then only pre-compressed using gzip
+    brotli = None
+
+resource_timeout = 10  # in seconds, the maximum time without receiving any data from a server
+resource_time_budget = 20  # in seconds, the maximum time spent downloading each resource
+page_time_budget = 60  # in seconds, the maximum time spent downloading the resources of a page
+resource_size_budget = 8 * 1024 * 1024  # in bytes, larger resources are not included
+page_size_budget = 32 * 1024 * 1024  # in bytes, for all the resources included in a page
+max_workers = 8
+
+_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='embed-inliner')
+
+max_import_depth = 4  # Levels of nested @import inlined in the stylesheets
+
+# An @import rule, with its url in the import or import_string group, or else a url() reference in the url group
+css_reference_pattern = re.compile(r'@import\s+(?:url\(\s*([\'"]?)(?P<import>[^\'")]*)\1\s*\)|([\'"])(?P<import_string>[^\'"]*)\3)'
+                                   r'(?P<media>[^;]*);|url\(\s*([\'"]?)(?P<url>[^\'")]+)\6\s*\)')
+css_charset_pattern = re.compile(r'@charset\s+[^;]*;')
+data_uri_pattern = re.compile(r'url\(data:[^)]*\)')
+doctype_pattern = re.compile(rb'\s*<!doctype', re.IGNORECASE)
+
+
+def inline(url, output_filename, logger, scripts=None, deduplicate=False, assets_dir=None, assets_url=None):
+    """
+    Inlines the page at the given url and its sub-resources in a single file. When deduplicate is set, the data uris
+    used several times in the styles of the page are only included once. When an assets directory and its url are
+    given, the images are written there as files named after their content instead of being included as data uris.
+    A gzip, and if possible brotli, compressed copy of the file is written along with it for static serving.
+    The resources exceeding the size and time budgets are skipped, and a list of (url, reason) tuples describing them
+    is returned.
+    """
     if scripts is None:
         scripts = []
+    deadline = time.time() + page_time_budget
+    remaining_size = page_size_budget
+    skipped = []
 
     def is_remote(address):
         return urllib.parse.urlparse(address)[0] in ('http', 'https')
@@ -49,13 +92,48 @@ def inline(url, output_filename, logger, scripts=None):
 
         return False
 
+    fetched = {}  # url -> remote Resource or exception raised while downloading it
+
+    def download(from_):
+        return fetch_resource(from_, resource_timeout, resource_size_budget,
+                              min(time.time() + resource_time_budget, deadline))
+
+    def prefetch(addresses):
+        """
+        Downloads concurrently the remote resources at the given addresses that were not downloaded yet, skipping
+        those exceeding the remaining budgets of the page.
+        """
+        nonlocal remaining_size
+        futures = {address: _executor.submit(download, address) for address in set(addresses)
+                   if is_remote(address) and not ignore_url(address) and address not in fetched}
+        for address, future in sorted(futures.items()):
+            try:
+                resource = future.result(timeout=max(0, deadline - time.time()))
+                if resource.size > remaining_size:
+                    raise ResourceSkipped('%s exceeds the remaining size budget of the page' % address)
+                remaining_size -= resource.size
+                fetched[address] = resource
+            except TimeoutError:
+                fetched[address] = ResourceSkipped('%s could not be downloaded in time' % address)
+            except Exception as e:
+                fetched[address] = e
+            if isinstance(fetched[address], ResourceSkipped):
+                skipped.append((address, str(fetched[address].reason)))
+
+    def get_resource(from_):
+        if from_ not in fetched:
+            prefetch([from_])
+        resource = fetched[from_]
+        if isinstance(resource, Exception):
+            raise resource
+        return resource
+
     def get_content(from_, expect_binary=False):
         if is_remote(from_):
             if ignore_url(from_):
                 return ''
 
-            with urllib.request.urlopen(from_) as f:
-                data = f.read()
+            data = get_resource(from_).content
             if expect_binary:
                 return data
             else:
@@ -64,111 +142,214 @@ def inline(url, output_filename, logger, scripts=None):
             with open(from_, "rb" if expect_binary else "r") as f:
                 return f.read()
 
+    def encode_resource(name, from_):
+        """ Returns the data uri of the given resource, reusing the base64 encoding stored in the cache if any. """
+        if assets_dir is not None:
+            return store_asset(name, from_)
+        if is_remote(from_) and not ignore_url(from_):
+            return 'data:%s;base64,%s' % (mimetypes.guess_type(name)[0], get_resource(from_).base64)
+        return data_encode_image(name, get_content(from_, True))
+
+    def store_asset(name, from_):
+        """ Writes the given resource in the assets directory if needed and returns its url. """
+        if is_remote(from_) and not ignore_url(from_):
+            resource = get_resource(from_)
+            content_hash, content = resource.hash, lambda: resource.content
+        else:
+            data = get_content(from_, True)
+            content_hash, content = hashlib.sha256(data).hexdigest(), lambda: data
+        asset = content_hash + (mimetypes.guess_extension(mimetypes.guess_type(name)[0] or '') or '')
+        asset_path = os.path.join(assets_dir, asset)
+        if not os.path.exists(asset_path):  # The assets are named after their content, they never change
+            write_file(asset_path, content())
+        return '%s/%s' % (assets_url, asset)
+
     def resolve_path(base, target):
-        if True:
-            return urllib.parse.urljoin(base, target)
+        return urllib.parse.urljoin(base, target.strip())
 
-        if is_remote(target):
-            return target
+    def css_references(css, base):
+        """ Returns the addresses of the stylesheets imported by the given CSS and of the other resources it uses. """
+        imports, addresses = [], []
+        for match in css_reference_pattern.finditer(css):
+            if match.group('url') is None:
+                imports.append(resolve_path(base, match.group('import') or match.group('import_string')))
+            elif not match.group('url').startswith(('data:', '#')):
+                addresses.append(resolve_path(base, match.group('url')))
+        return imports, addresses
 
-        if target.startswith('/'):
-            if is_remote(base):
-                protocol, rest = base.split('://')
-                return '%s://%s%s' % (protocol, rest.split('/')[0], target)
-            else:
-                return target
-        else:
-            try:
-                base, rest = base.rsplit('/', 1)
-                return '%s/%s' % (base, target)
-            except ValueError:
-                return target
+    def prefetch_css_references(css_texts):
+        """ Downloads the resources used by the given (CSS, base url) pairs, following the imports level by level. """
+        for _ in range(max_import_depth + 1):
+            imports, addresses = [], []
+            for css, base in css_texts:
+                css_imports, css_addresses = css_references(css, base)
+                imports += css_imports
+                addresses += css_addresses
+            prefetch(imports + addresses)
+            css_texts = []
+            for address in imports:
+                try:
+                    css_texts.append((get_content(address), address))
+                except Exception:
+                    pass  # The failure is reported when rewriting the CSS
+            if not css_texts:
+                break
 
-    def replace_javascript(base_url, soup):
-        for js in soup.find_all('script', {'src': re.compile('.+')}):
+    def rewrite_css(css, base, depth=0):
+        """ Inlines the stylesheets imported by the given CSS and replaces the urls of the resources it uses. """
+        def replacer(match):
+            if match.group('url') is None:
+                address = resolve_path(base, match.group('import') or match.group('import_string'))
+                if depth >= max_import_depth:
+                    return '@import url(%s)%s;' % (address, match.group('media'))
+                try:
+                    imported = css_charset_pattern.sub('', rewrite_css(get_content(address), address, depth + 1))
+                except Exception as e:
+                    logger.info('Failed to load css from %s' % address)
+                    logger.info(e)
+                    return '@import url(%s)%s;' % (address, match.group('media'))
+                media = match.group('media').strip()
+                return '@media %s {\n%s\n}' % (media, imported) if media else imported
+
+            target = match.group('url')
+            if target.startswith(('data:', '#')):
+                return match.group()
+            path = resolve_path(base, target)
             try:
-                real_js = get_content(resolve_path(base_url, js['src']))
-                new_tag = soup.new_tag('script')
-                new_tag.string = real_js
-                js.replace_with(new_tag)
+                return 'url(%s)' % encode_resource(path, path)
             except Exception as e:
-                logger.info('Failed to load javascript from %s' % js['src'])
-                logger.info(e)
+                logger.debug('Failed to encode css for path %s' % path)
+                logger.debug(e)
+                return 'url(%s)' % path
+
+        return css_reference_pattern.sub(replacer, css)
 
-    css_url = re.compile(r'url\((.+)\)')
+    source = get_content(url, True)
+    root = lxml.html.document_fromstring(source, parser=lxml.html.HTMLParser(encoding='utf-8'))
 
-    def replace_css(base_url, soup):
-        for css in soup.findAll('link', {'rel': 'stylesheet', 'href': re.compile('.+')}):
+    # The rewrite targets are found in a single traversal, then all the sub-resources are downloaded concurrently
+    # before the page is modified
+    targets = []  # (element, kind of target, address of the resource or base url of the CSS)
+    addresses = []
+    css_texts = []
+    for e in root.iter():
+        if not isinstance(e.tag, str):
+            continue  # Comments and processing instructions
+        if e.tag == 'script' and e.get('src'):
+            targets.append((e, 'script', resolve_path(url, e.get('src'))))
+        elif e.tag == 'link' and 'stylesheet' in (e.get('rel') or '').lower().split() and e.get('href'):
+            targets.append((e, 'stylesheet', resolve_path(url, e.get('href'))))
+        elif e.tag == 'style' and e.text:
+            targets.append((e, 'style', url))
+            css_texts.append((e.text, url))
+        elif (e.tag == 'img' or e.tag == 'input' and (e.get('type') or '').lower() == 'image') and e.get('src'):
+            targets.append((e, 'image', resolve_path(url, e.get('src'))))
+        if 'url(' in (e.get('style') or ''):
+            targets.append((e, 'style_attribute', url))
+            css_texts.append((e.get('style'), url))
+    addresses += [address for _, kind, address in targets if kind in ('script', 'stylesheet', 'image')]
+    prefetch(addresses)
+    for _, kind, address in targets:
+        if kind == 'stylesheet':
             try:
-                real_css = get_content(resolve_path(base_url, css['href']))
+                css_texts.append((get_content(address), address))
+            except Exception:
+                pass  # The failure is reported when replacing the stylesheet
+    prefetch_css_references(css_texts)
 
-                def replacer(result):
-                    try:
-                        path = resolve_path(resolve_path(base_url, css['href']), result.groups()[0])
-                        return 'url(%s)' % data_encode_image(path, get_content(path, True))
-                    except Exception as e:
-                        logger.debug('Failed to encode css for path %s' % path)
-                        logger.debug(e)
-                        return ''
+    styles = []  # The elements whose CSS was rewritten
+    for e, kind, address in targets:
+        if kind == 'script':
+            try:
+                e.text = get_content(address)
+                del e.attrib['src']
+            except Exception as ex:
+                logger.info('Failed to load javascript from %s' % e.get('src'))
+                logger.info(ex)
+        elif kind == 'stylesheet':
+            try:
+                style = lxml.html.Element('style')
+                style.text = rewrite_css(get_content(address), address)
+                if e.get('media'):
+                    style.set('media', e.get('media'))
+                style.tail = e.tail
+                e.getparent().replace(e, style)
+                styles.append((style, kind))
+            except Exception as ex:
+                logger.info('Failed to load css from %s' % e.get('href'))
+                logger.info(ex)
+        elif kind == 'style':
+            e.text = rewrite_css(e.text, address)
+            styles.append((e, kind))
+        elif kind == 'image':
+            try:
+                e.set('src', encode_resource(address.lower(), address))
+            except Exception as ex:
+                logger.info('Failed to load image from %s' % e.get('src'))
+                logger.info(ex)
+        elif kind == 'style_attribute':
+            e.set('style', rewrite_css(e.get('style'), address))
+            styles.append((e, kind))
 
-                new_tag = soup.new_tag('style')
-                new_tag.string = re.sub(css_url, replacer, real_css)
-                css.replaceWith(new_tag)
+    head = root.find('head')
+    if head is None:
+        head = lxml.html.Element('head')
+        root.insert(0, head)
+    body = root.find('body')
+    if body is None:
+        body = lxml.html.Element('body')
+        root.append(body)
 
-            except Exception as e:
-                logger.info('Failed to load css from %s' % css['href'])
-                logger.info(e)
+    if deduplicate and assets_dir is None:
+        deduplicate_data_uris(head, styles)
 
-    def replace_images(base_url, soup):
-        from itertools import chain
+    for script in scripts:
+        script_tag = lxml.html.Element('script')
+        script_tag.set('src', script)
+        head.append(script_tag)
 
-        for img in chain(soup.findAll('img', {'src': re.compile('.+')}),
-                         soup.findAll('input', {'type': 'image', 'src': re.compile('.+')})):
-            try:
-                path = resolve_path(base_url, img['src'])
-                real_img = get_content(path, True)
-                img['src'] = data_encode_image(path.lower(), real_img)
-            except Exception as e:
-                logger.info('Failed to load image from %s' % img['src'])
-                logger.info(e)
+    prevent_error_script = lxml.html.Element('script')
+    prevent_error_script.text = "window.onerror = function(e) {console.log(e); return true;};"
+    prevent_error_script.tail, body.text = body.text, None
+    body.insert(0, prevent_error_script)
 
-    def replace_backgrounds(base_url, soup):
-        for e in soup.find_all(style=lambda x: x and 'background-image' in x):
-            new_style = []
-            try:
-                for property, value in [(p.strip(), v.strip()) for (p, v) in
-                                        [x.strip().split(':') for x in e['style'].strip().split(';') if len(x) > 0]]:
-                    if (
-                            property == 'background-image' or property == 'background') and 'url(' in value and not 'url(data' in value:
-                        url = value[value.find("(") + 1:value.find(")")]
-                        path = resolve_path(base_url, url)
-                        img = data_encode_image(path.lower(), get_content(path, True))
-                        new_style.append((property, value.replace(url, img)))
-                    else:
-                        new_style.append((property, value))
-                e['style'] = '; '.join(property + ': ' + value for property, value in new_style)
-            except Exception as e:
-                logger.info('Failed to load background-image from %s' % e['style'])
-                logger.info(e)
+    if skipped:
+        logger.warning('%d resources of %s were skipped: %s' % (len(skipped), url, '; '.join(r for _, r in skipped)))
 
-    soup = BeautifulSoup(get_content(url), 'lxml')
+    page = lxml.html.tostring(root, encoding='utf-8', method='html')
+    if doctype_pattern.match(source):  # Otherwise the parser adds one, which could change the rendering mode
+        page = root.getroottree().docinfo.doctype.encode('utf-8') + b'\n' + page
+    write_file(output_filename, page)
+    write_file(output_filename + '.gz', gzip.compress(page, compresslevel=9, mtime=0))
+    if brotli is not None:
+        write_file(output_filename + '.br', brotli.compress(page))
+    return skipped
 
-    replace_javascript(url, soup)
-    replace_css(url, soup)
-    replace_images(url, soup)
-    replace_backgrounds(url, soup)
 
-    for script in scripts:
-        script_tag = soup.new_tag('script')
-        script_tag['src'] = script
-        soup.head.append(script_tag)
+def deduplicate_data_uris(head, styles):
+    """
+    Defines the data uris used several times in the given (element, kind) styles as CSS variables declared once in
+    the head of the page.
+    """
+    def get_css(e, kind):
+        return e.get('style') if kind == 'style_attribute' else e.text or ''
 
-    prevent_error_script = soup.new_tag('script')
-    prevent_error_script.string = "window.onerror = function(e) {console.log(e); return true;};"
-    soup.body.insert(0, prevent_error_script)
+    counts = Counter(uri for e, kind in styles for uri in data_uri_pattern.findall(get_css(e, kind)))
+    variables = {uri: '--ictv-resource-%d' % i for i, uri in enumerate(u for u, c in counts.items() if c > 1)}
+    if not variables:
+        return
 
-    with open(output_filename, 'wb') as res:
-        res.write(str(soup).encode("utf-8"))
+    def replacer(match):
+        return 'var(%s)' % variables[match.group()] if match.group() in variables else match.group()
+
+    for e, kind in styles:
+        if kind == 'style_attribute':
+            e.set('style', data_uri_pattern.sub(replacer, e.get('style')))
+        else:
+            e.text = data_uri_pattern.sub(replacer, e.text or '')
+    variables_style = lxml.html.Element('style')
+    variables_style.text = ':root { %s }' % ' '.join('%s: %s;' % (v, uri) for uri, v in variables.items())
+    head.append(variables_style)  # Appended, so that the declarations never push a meta charset out of the first bytes
 
 
 if __name__ == '__main__':
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Maintenance of the caches of the embed channels: inventory of the cached pages, removal of those that do not belong
+to any channel anymore and warm-up of the caches, e.g. after a deploy.
+
+Usage: python3 -m ictv.plugins.embed.maintenance --config /path/to/config.yaml {inventory,gc,warm-up}
+"""
+
+import argparse
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import ictv.plugin_manager.plugin_manager
+from ictv.common import get_root_path
+from ictv.models.channel import PluginChannel
+from ictv.models.plugin import Plugin
+from ictv.plugins.embed.embed import get_file_hash, get_paths, get_mtime, get_expiration_time, get_inline_params, \
+    rebuild_cache, create_iframe_page, assets_page, locks_dir
+
+cache_file_pattern = re.compile(r'^(iframe_)?(?P<hash>[0-9a-f]{32})\.html(\.gz|\.br)?$')
+asset_reference_pattern = re.compile(rb'/static/' + re.escape(assets_page.encode()) + rb'/([0-9a-f]{64}[.\w]*)')
+
+grace_period = 24 * 60 * 60  # in seconds, unreferenced assets and temporary files younger than this are kept
+
+
+def get_embed_channels():
+    return list(PluginChannel.selectBy(plugin=Plugin.selectBy(name='embed').getOne()))
+
+
+def get_inventory():
+    """
+    Returns the cache of each embed channel, as dicts describing its page, and the files of the cache directory that
+    do not belong to any channel, as a list of paths.
+    """
+    static_dir = os.path.join(get_root_path(), 'static', 'plugins', 'embed')
+    channels = []
+    live_hashes = set()
+    for channel in get_embed_channels():
+        link = channel.get_config_param('link')
+        if not link:
+            continue
+        file_hash = get_file_hash(channel.id, link)
+        live_hashes.add(file_hash)
+        _, _, _, full_inlined_page_path = get_paths(file_hash)
+        built_time = get_mtime(full_inlined_page_path)
+        channels.append({'channel_id': channel.id, 'channel_name': channel.name, 'link': link, 'hash': file_hash,
+                         'built': built_time,
+                         'expired': built_time is None or get_expiration_time(
+                             built_time, channel.get_config_param('refresh_rate'), file_hash) < time.time(),
+                         'size': os.path.getsize(full_inlined_page_path) if built_time is not None else 0})
+
+    now = time.time()
+    orphans = []
+    for name in os.listdir(static_dir) if os.path.isdir(static_dir) else []:
+        path = os.path.join(static_dir, name)
+        match = cache_file_pattern.match(name)
+        if match and match.group('hash') not in live_hashes:
+            orphans.append(path)
+        elif name.endswith('.tmp') and now - os.path.getmtime(path) > grace_period:
+            orphans.append(path)  # Left by an interrupted write
+    for name in os.listdir(locks_dir):
+        if name[:-len('.lock')] not in live_hashes:
+            orphans.append(os.path.join(locks_dir, name))
+
+    assets_dir = os.path.join(get_root_path(), 'static', assets_page)
+    if os.path.isdir(assets_dir):
+        referenced = set()
+        for file_hash in live_hashes:
+            _, _, _, full_inlined_page_path = get_paths(file_hash)
+            try:
+                with open(full_inlined_page_path, 'rb') as f:
+                    referenced.update(asset_reference_pattern.findall(f.read()))
+            except OSError:
+                pass
+        for name in os.listdir(assets_dir):
+            path = os.path.join(assets_dir, name)
+            if name.encode() not in referenced and now - os.path.getmtime(path) > grace_period:
+                orphans.append(path)
+    return channels, orphans
+
+
+def collect_garbage(dry_run=False):
+    """ Removes the cache files that do not belong to any embed channel. Returns the removed paths. """
+    _, orphans = get_inventory()
+    removed = []
+    for path in orphans:
+        if not dry_run:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+        removed.append(path)
+    return removed
+
+
+def warm_up(max_workers=4, force=False):
+    """
+    Builds concurrently the caches of the embed channels that are missing or expired, or all of them if force is set.
+    Returns a dict mapping the id of each channel rebuilt to None or to the exception raised while rebuilding it.
+    """
+    tasks = {}
+    for channel in get_embed_channels():  # The parameters are read beforehand, the rebuilds do not use the database
+        link = channel.get_config_param('link')
+        width, height = channel.get_config_param('width'), channel.get_config_param('height')
+        if not link or width is None or height is None:
+            continue
+        file_hash = get_file_hash(channel.id, link)
+        _, _, inlined_page, full_inlined_page_path = get_paths(file_hash)
+        built_time = get_mtime(full_inlined_page_path)
+        if force or built_time is None or \
+                get_expiration_time(built_time, channel.get_config_param('refresh_rate'), file_hash) < time.time():
+            scripts, inline_options = get_inline_params(channel)
+            logger = ictv.plugin_manager.plugin_manager.get_logger('embed', channel)
+            tasks[channel.id] = (link, scripts, inline_options, file_hash, logger, built_time, inlined_page, width, height)
+
+    def build(link, scripts, inline_options, file_hash, logger, built_time, inlined_page, width, height):
+        rebuild_cache(link, scripts, inline_options, file_hash, logger, built_time)
+        create_iframe_page('/static/' + inlined_page, width, height, file_hash)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='embed-warm-up') as executor:
+        futures = {channel_id: executor.submit(build, *task) for channel_id, task in tasks.items()}
+        for channel_id, future in futures.items():
+            try:
+                future.result()
+                results[channel_id] = None
+            except Exception as e:
+                results[channel_id] = e
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintenance of the caches of the embed channels.')
+    parser.add_argument('--config', required=True, help='the configuration file of ICTV')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    subparsers.add_parser('inventory', help='list the cached pages and the orphan files')
+    gc_parser = subparsers.add_parser('gc', help='remove the files that do not belong to any channel')
+    gc_parser.add_argument('--dry-run', action='store_true', help='only list the files that would be removed')
+    warm_up_parser = subparsers.add_parser('warm-up', help='build the missing or expired caches')
+    warm_up_parser.add_argument('--workers', type=int, default=4, help='number of caches built concurrently')
+    warm_up_parser.add_argument('--force', action='store_true', help='rebuild all the caches')
+    args = parser.parse_args()
+
+    from ictv.app import get_app, get_config
+    get_app(get_config(args.config))  # Sets up the database connection and the plugins
+
+    if args.command == 'inventory':
+        channels, orphans = get_inventory()
+        for c in channels:
+            print('%5d %-30s %s %s %8d bytes %s' % (c['channel_id'], c['channel_name'][:30], c['hash'],
+                                                   'expired' if c['expired'] else 'fresh  ', c['size'], c['link']))
+        print('%d orphan files, %d bytes' % (len(orphans), sum(os.path.getsize(p) for p in orphans)))
+        for path in orphans:
+            print('  ' + path)
+    elif args.command == 'gc':
+        removed = collect_garbage(args.dry_run)
+        print('%s %d files' % ('Would remove' if args.dry_run else 'Removed', len(removed)))
+        for path in removed:
+            print('  ' + path)
+    elif args.command == 'warm-up':
+        results = warm_up(args.workers, args.force)
+        for channel_id, error in sorted(results.items()):
+            print('%5d %s' % (channel_id, 'ok' if error is None else 'failed: %s' % error))
+        print('%d caches built, %d failed' % (sum(e is None for e in results.values()),
+                                              sum(e is not None for e in results.values())))
+
+
+if __name__ == '__main__':
+    main()
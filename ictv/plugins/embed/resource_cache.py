@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import urllib.request
+from email.utils import parsedate_to_datetime
+from urllib.error import HTTPError, URLError
+
+cache_dir = os.path.join(os.path.dirname(__file__), 'cache')
+blobs_dir = os.path.join(cache_dir, 'blobs')
+os.makedirs(blobs_dir, exist_ok=True)
+db_path = os.path.join(cache_dir, 'resources.sqlite')
+
+max_cache_size = 256 * 1024 * 1024  # in bytes, for all the blobs of the cache
+max_resource_size = 16 * 1024 * 1024  # in bytes, larger resources are not cached
+chunk_size = 64 * 1024  # in bytes, the responses are read by chunks so that a download can stop early
+
+max_age_pattern = re.compile(r'max-age\s*=\s*"?(\d+)')
+
+_local = threading.local()
+
+
+class ResourceSkipped(URLError):
+    """ Raised when a resource exceeds its size or time budget. """
+    pass
+
+
+class Resource(object):
+    """
+    A sub-resource of an embedded page. Its content is stored once per distinct content in the cache, along with its
+    base64 encoding, so that the resources shared by several urls or pages are only stored and encoded once.
+    """
+    def __init__(self, content_hash, size, content=None):
+        self.hash = content_hash
+        self.size = size
+        self._content = content
+
+    @property
+    def content(self):
+        if self._content is None:
+            with open(_blob_path(self.hash), 'rb') as f:
+                self._content = f.read()
+        return self._content
+
+    @property
+    def base64(self):
+        try:
+            with open(_blob_path(self.hash) + '.b64', 'r') as f:
+                return f.read()
+        except OSError:
+            return base64.standard_b64encode(self.content).decode('utf-8')
+
+
+def get_db():
+    """ Returns the SQLite connection of the current thread to the index of the cache. """
+    db = getattr(_local, 'db', None)
+    if db is None:
+        db = sqlite3.connect(db_path, timeout=30)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS resources (url TEXT PRIMARY KEY, hash TEXT NOT NULL, etag TEXT, '
+                       'last_modified TEXT, expires REAL NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS resources_hash ON resources (hash)')
+            db.execute('CREATE INDEX IF NOT EXISTS resources_last_access ON resources (last_access)')
+        _local.db = db
+    return db
+
+
+def fetch_resource(url, timeout, max_size=None, deadline=None):
+    """
+    Returns the Resource at the given url. A cached resource is returned without any request while it is fresh
+    according to its Cache-Control or Expires headers, and is revalidated using its ETag and Last-Modified validators
+    afterwards, so that only the resources that changed are downloaded again. The download is stopped and
+    ResourceSkipped is raised as soon as the resource is known to be larger than max_size bytes or when the deadline
+    is reached.
+    """
+    db = get_db()
+    now = time.time()
+    cached = db.execute('SELECT hash, etag, last_modified, expires, size FROM resources WHERE url = ?',
+                        (url,)).fetchone()
+    if cached and not os.path.exists(_blob_path(cached[0])):
+        cached = None  # The blob was removed, e.g. by the eviction of another process
+    if cached:
+        content_hash, etag, last_modified, expires, size = cached
+        if max_size is not None and size > max_size:
+            raise ResourceSkipped('%s is larger than %d bytes' % (url, max_size))
+        if now < expires:
+            _touch_resource(url, now)
+            return Resource(content_hash, size)
+
+    request = urllib.request.Request(url)
+    if cached and etag:
+        request.add_header('If-None-Match', etag)
+    if cached and last_modified:
+        request.add_header('If-Modified-Since', last_modified)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            content = _read_response(url, response, max_size, deadline)
+            headers = response.headers
+    except HTTPError as e:
+        if e.code != 304 or not cached:
+            raise
+        with db:
+            db.execute('UPDATE resources SET expires = ?, last_access = ? WHERE url = ?',
+                       (_get_expiration_time(e.headers, now) or now, now, url))
+        return Resource(content_hash, size)
+
+    content_hash = hashlib.sha256(content).hexdigest()
+    _store_resource(url, content_hash, content, headers, now)
+    return Resource(content_hash, len(content), content)
+
+
+def _read_response(url, response, max_size, deadline):
+    """ Reads the body of the response by chunks, stopping as soon as it exceeds its size or time budget. """
+    length = response.headers.get('Content-Length')
+    if max_size is not None and length and length.isdigit() and int(length) > max_size:
+        raise ResourceSkipped('%s is larger than %d bytes' % (url, max_size))
+    chunks = []
+    size = 0
+    while True:
+        chunk = response.read(chunk_size)
+        if not chunk:
+            return b''.join(chunks)
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise ResourceSkipped('%s is larger than %d bytes' % (url, max_size))
+        if deadline is not None and time.time() > deadline:
+            raise ResourceSkipped('%s could not be downloaded in time' % url)
+        chunks.append(chunk)
+
+
+def _get_expiration_time(headers, now):
+    """ Returns the time until which a response can be used without revalidation, or None if it cannot be stored. """
+    cache_control = (headers.get('Cache-Control') or '').lower()
+    if 'no-store' in cache_control or 'private' in cache_control:
+        return None
+    if 'no-cache' in cache_control:
+        return now
+    max_age = max_age_pattern.search(cache_control)
+    if max_age:
+        return now + int(max_age.group(1))
+    if headers.get('Expires'):
+        try:
+            return max(now, parsedate_to_datetime(headers['Expires']).timestamp())
+        except (TypeError, ValueError):
+            return now
+    return now
+
+
+def _store_resource(url, content_hash, content, headers, now):
+    expires = _get_expiration_time(headers, now)
+    if expires is None or len(content) > max_resource_size:
+        return  # This resource cannot be reused later
+    path = _blob_path(content_hash)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file(path + '.b64', base64.standard_b64encode(content))
+        write_file(path, content)  # Written last, as its presence marks the blob as complete
+    db = get_db()
+    with db:
+        db.execute('INSERT OR REPLACE INTO resources (url, hash, etag, last_modified, expires, size, last_access) '
+                   'VALUES (?, ?, ?, ?, ?, ?, ?)', (url, content_hash, headers.get('ETag'), headers.get('Last-Modified'),
+                                                    expires, len(content), now))
+        evicted = _evict_resources(db)
+    for evicted_hash in evicted:
+        _remove_blob(evicted_hash)
+
+
+def _touch_resource(url, now):
+    db = get_db()
+    with db:
+        db.execute('UPDATE resources SET last_access = ? WHERE url = ?', (now, url))
+
+
+def _evict_resources(db):
+    """
+    Removes the least recently used urls until the blobs fit in the maximum size of the cache. Returns the hashes of
+    the blobs that are not referenced anymore.
+    """
+    excess = db.execute('SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM resources GROUP BY hash)')\
+        .fetchone()[0] - max_cache_size
+    if excess <= 0:
+        return []
+    evicted = set()
+    for url, content_hash, size in db.execute('SELECT url, hash, size FROM resources ORDER BY last_access').fetchall():
+        db.execute('DELETE FROM resources WHERE url = ?', (url,))
+        if not db.execute('SELECT 1 FROM resources WHERE hash = ?', (content_hash,)).fetchone():
+            evicted.add(content_hash)
+            excess -= size
+            if excess <= 0:
+                break
+    return evicted
+
+
+def _blob_path(content_hash):
+    return os.path.join(blobs_dir, content_hash[:2], content_hash)
+
+
+def write_file(path, content):
+    """ Writes the given content to a temporary file renamed afterwards, so that a partial file is never served. """
+    tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _remove_blob(content_hash):
+    for path in (_blob_path(content_hash), _blob_path(content_hash) + '.b64'):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
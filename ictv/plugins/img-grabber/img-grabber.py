@@ -19,16 +19,245 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
 from urllib.parse import urlparse, urljoin
 
 from pyquery import PyQuery
 
+from ictv.common import get_root_path
 from ictv.models.channel import PluginChannel
 from ictv.plugin_manager.plugin_capsule import PluginCapsule
 from ictv.plugin_manager.plugin_manager import get_logger
 from ictv.plugin_manager.plugin_slide import PluginSlide
 from ictv.plugin_manager.plugin_utils import MisconfiguredParameters
 
+try:
+    from wand.image import Image
+except ImportError:  # The images are then used as is from their remote host
+    Image = None
+
+static_dir = os.path.join(os.path.dirname(__file__), 'static')
+if not os.path.exists(static_dir):
+    os.mkdir(static_dir)
+cache_dir = os.path.join(os.path.dirname(__file__), 'cache')  # The last capsule successfully built for each channel
+os.makedirs(cache_dir, exist_ok=True)
+
+page_ttl = 60  # in seconds, a page is reused by all the channels without any request during this time
+max_page_staleness = 15 * 60  # in seconds, an older page is no longer used when it cannot be revalidated
+page_timeout = 15  # in seconds, both to connect and between two reads
+fetch_retries = 2
+retry_backoff = 1  # in seconds, doubled after each retry
+max_pages = 64
+
+_refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='img-grabber-refresh')
+
+_pages = {}  # url -> CachedPage
+_pages_lock = threading.Lock()
+_page_locks = {}  # url -> threading.Lock, so that a page is fetched once when several channels refresh at once
+_last_content = {}  # channel_id -> (signature of the capsule, capsules)
+
+max_image_width = 1920  # in pixels, larger images are downscaled to the resolution of the screens
+max_image_height = 1080
+max_image_size = 32 * 1024 * 1024  # in bytes, larger images are used as is from their remote host
+image_max_age = 7 * 24 * 60 * 60  # in seconds, the local images that were not used during this time are removed
+image_cleanup_interval = 24 * 60 * 60
+image_ttl = 60  # in seconds, an image is reused without any request during this time, then revalidated
+
+_local_images = {}  # url of the remote image -> LocalImage
+_local_images_lock = threading.Lock()
+_last_image_cleanup = 0
+
+
+class CachedPage(object):
+    def __init__(self, doc, etag, last_modified, fetch_time):
+        self.doc = doc
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetch_time = fetch_time
+
+
+class LocalImage(object):
+    def __init__(self, url, etag, last_modified, check_time):
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.check_time = check_time
+
+
+def get_page(url, logger=None, wait=True):
+    """
+    Returns the parsed document of the page at the given url. The documents are shared by all the channels and
+    reused without any request for page_ttl seconds. Afterwards, the previous document is still returned while the
+    page is revalidated in the background using its ETag and Last-Modified validators, so that a slow or failing
+    page never delays the refreshes once it has been fetched. A document that could not be revalidated for
+    max_page_staleness seconds is no longer returned. When there is no document to return, the page is fetched, or
+    if wait is False, it is fetched in the background and None is returned. The errors of the background fetches are
+    logged with the given logger, if any.
+    """
+    with _pages_lock:
+        page = _pages.get(url)
+    if page is None or time.time() - page.fetch_time >= max_page_staleness:
+        if wait:
+            return refresh_page(url)
+        refresh_page_in_background(url, logger)
+        return None
+    if time.time() - page.fetch_time >= page_ttl:
+        refresh_page_in_background(url, logger)
+    return page.doc
+
+
+def refresh_page_in_background(url, logger=None):
+    def log_error(future):
+        if future.exception() is not None and logger is not None:
+            logger.warning('Could not refresh %s in the background: %s' % (url, str(future.exception())))
+    _refresh_executor.submit(refresh_page, url).add_done_callback(log_error)
+
+
+def refresh_page(url):
+    """ Fetches the page at the given url, unless it is already being fetched, and returns its parsed document. """
+    with _pages_lock:
+        page_lock = _page_locks.setdefault(url, threading.Lock())
+        page = _pages.get(url)
+    if not page_lock.acquire(blocking=page is None or time.time() - page.fetch_time >= max_page_staleness):
+        return page.doc  # The page is being fetched for another channel
+    try:
+        with _pages_lock:
+            page = _pages.get(url)
+        now = time.time()
+        if page and now - page.fetch_time < page_ttl:
+            return page.doc
+        body, headers = fetch_page(url, page)
+        if body is None:  # Not modified
+            page.fetch_time = now
+            return page.doc
+
+        page = CachedPage(PyQuery(body), headers.get('ETag'), headers.get('Last-Modified'), now)
+        with _pages_lock:
+            _pages[url] = page
+            if len(_pages) > max_pages:
+                oldest = min(_pages, key=lambda u: _pages[u].fetch_time)
+                del _pages[oldest]
+        return page.doc
+    finally:
+        page_lock.release()
+
+
+def fetch_page(url, page):
+    """
+    Downloads the page at the given url, sending the validators of the given previous copy if any. Returns its body
+    and headers, or (None, None) if it was not modified. Network and server errors are retried fetch_retries times
+    with an exponential backoff.
+    """
+    request = urllib.request.Request(url)
+    if page and page.etag:
+        request.add_header('If-None-Match', page.etag)
+    if page and page.last_modified:
+        request.add_header('If-Modified-Since', page.last_modified)
+    for attempt in range(fetch_retries + 1):
+        try:
+            with urllib.request.urlopen(request, timeout=page_timeout) as response:
+                return response.read(), response.headers
+        except HTTPError as e:
+            if e.code == 304 and page:
+                return None, None
+            if e.code < 500 or attempt == fetch_retries:
+                raise
+        except (URLError, OSError):  # Including timeouts
+            if attempt == fetch_retries:
+                raise
+        time.sleep(retry_backoff * 2 ** attempt)
+
+
+def get_local_image(img_url):
+    """
+    Downloads the given image and stores a copy downscaled to the resolution of the screens, named after the hash of
+    the original image. Returns the url of the copy, or the given url if the image is animated or too large. The
+    image is reused without any request for image_ttl seconds, then revalidated using its ETag and Last-Modified
+    validators, so that a new image published at the same url is noticed.
+    """
+    with _local_images_lock:
+        local_image = _local_images.get(img_url)
+    path = get_image_path(local_image.url) if local_image else None
+    if path and not os.path.exists(path):
+        local_image = path = None  # Removed by the cleanup
+    if local_image and time.time() - local_image.check_time < image_ttl:
+        if path:
+            os.utime(path)  # Marks the image as used
+        return local_image.url
+
+    request = urllib.request.Request(img_url)
+    if local_image and local_image.etag:
+        request.add_header('If-None-Match', local_image.etag)
+    if local_image and local_image.last_modified:
+        request.add_header('If-Modified-Since', local_image.last_modified)
+    check_time = time.time()
+    try:
+        with urllib.request.urlopen(request, timeout=page_timeout) as response:
+            data = response.read(max_image_size + 1)
+            etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+    except HTTPError as e:
+        if e.code != 304 or local_image is None:
+            raise
+        local_image.check_time = check_time
+        if path:
+            os.utime(path)
+        return local_image.url
+
+    images_dir = os.path.join(get_root_path(), 'static', 'plugins', 'img-grabber')
+    os.makedirs(images_dir, exist_ok=True)
+    local_url = img_url
+    if len(data) <= max_image_size:
+        with Image(blob=data) as img:
+            if len(img.sequence) == 1:  # Animated images are kept as is
+                extension = 'png' if img.alpha_channel else 'jpg'
+                filename = '%s.%s' % (hashlib.sha256(data).hexdigest(), extension)
+                path = os.path.join(images_dir, filename)
+                if not os.path.exists(path):
+                    img.auto_orient()
+                    img.transform(resize='%dx%d>' % (max_image_width, max_image_height))
+                    img.strip()
+                    img.format = extension
+                    if extension == 'jpg':
+                        img.compression_quality = 85
+                    write_file(path, img.make_blob())
+                else:
+                    os.utime(path)
+                local_url = '/static/plugins/img-grabber/' + filename
+    with _local_images_lock:
+        _local_images[img_url] = LocalImage(local_url, etag, last_modified, check_time)
+    cleanup_local_images(images_dir)
+    return local_url
+
+
+def get_image_path(local_url):
+    """ Returns the path of the given local image, or None if the url is the one of a remote image. """
+    if not local_url.startswith('/static/plugins/img-grabber/'):
+        return None
+    return os.path.join(get_root_path(), local_url.lstrip('/'))
+
+
+def cleanup_local_images(images_dir):
+    """ Removes the local images that were not used recently, at most once per image_cleanup_interval. """
+    global _last_image_cleanup
+    now = time.time()
+    if now - _last_image_cleanup < image_cleanup_interval:
+        return
+    _last_image_cleanup = now
+    for filename in os.listdir(images_dir):
+        path = os.path.join(images_dir, filename)
+        try:
+            if now - os.path.getmtime(path) > image_max_age:
+                os.remove(path)
+        except OSError:
+            pass
+
 
 def get_content(channel_id):
     channel = PluginChannel.get(channel_id)
@@ -41,12 +270,27 @@ def get_content(channel_id):
     if not url or not image_selector or not attr:
         logger.warning('Some of the required parameters are empty', extra=logger_extra)
         return []
+    params = [url, image_selector, attr, channel.get_config_param('text_selector')]
     try:
-        doc = PyQuery(url=url)
+        doc = get_page(url, logger, wait=False)
+        if doc is None:
+            last_good = get_last_good_capsule(channel_id, params)
+            if last_good:
+                logger.debug('The page %s is being fetched, the last capsule built is used' % url, extra=logger_extra)
+                return last_good
+            doc = get_page(url, logger)
     except Exception as e:
+        last_good = get_last_good_capsule(channel_id, params)
+        if last_good:
+            logger.warning('Could not fetch %s, the last capsule built is used: %s' % (url, str(e)), extra=logger_extra)
+            return last_good
         raise MisconfiguredParameters('url', url, 'The following error was encountered: %s.' % str(e))
     img = doc(image_selector).eq(0).attr(attr)
     if not img:
+        last_good = get_last_good_capsule(channel_id, params)
+        if last_good:
+            logger.warning('Could not find the image in %s, the last capsule built is used' % url, extra=logger_extra)
+            return last_good
         message = 'Could not find img with CSS selector %s and attribute %s' % (image_selector, attr)
         raise MisconfiguredParameters('image_selector', image_selector, message).add_faulty_parameter('src_attr', attr, message)
     img = urljoin(url, img)
@@ -54,7 +298,54 @@ def get_content(channel_id):
     text = doc(channel.get_config_param('text_selector')).eq(0).text()
     alternative_text = channel.get_config_param('alternative_text')
     color = channel.get_config_param('color')
-    return [ImgGrabberCapsule(img, text if text else alternative_text, duration, color, qrcode=url if qrcode else None)]
+    img_src = img
+    if channel.get_config_param('optimize_image') and Image is not None:
+        try:
+            img_src = get_local_image(img)
+        except Exception as e:
+            logger.warning('Could not store a local copy of the image %s, the original is used: %s' % (img, str(e)),
+                           extra=logger_extra)
+    signature = (img_src, text if text else alternative_text, duration, color, qrcode, url)
+    last_content = _last_content.get(channel_id)
+    if last_content and last_content[0] == signature:
+        return list(last_content[1])  # Neither the image nor the text changed
+    capsule_args = [img_src, text if text else alternative_text, duration, color, url if qrcode else None]
+    capsules = [ImgGrabberCapsule(*capsule_args)]
+    _last_content[channel_id] = (signature, capsules)
+    store_last_good_capsule(channel_id, params, capsule_args)
+    return list(capsules)
+
+
+def get_last_good_capsule(channel_id, params):
+    """
+    Returns the last capsules successfully built for the channel, if they were built with the same page and
+    selectors, so that the changes of these parameters are still validated.
+    """
+    try:
+        with open(os.path.join(cache_dir, '%d.json' % channel_id), 'r') as f:
+            last_good = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if last_good.get('params') != params:
+        return None
+    return [ImgGrabberCapsule(*last_good['capsule'])]
+
+
+def store_last_good_capsule(channel_id, params, capsule_args):
+    write_file(os.path.join(cache_dir, '%d.json' % channel_id),
+               json.dumps({'params': params, 'capsule': capsule_args}).encode())
+
+
+def write_file(path, content):
+    """ Writes the given content to a temporary file renamed afterwards, so that a partial file is never used. """
+    tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 class ImgGrabberCapsule(PluginCapsule):
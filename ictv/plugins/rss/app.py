@@ -36,8 +36,11 @@ from ictv.common.feedbacks import get_feedbacks, get_next_feedbacks, pop_previou
 from ictv.common.json_datetime import DateTimeEncoder
 from ictv.pages.channel_page import ChannelPage
 from ictv.pages.utils import ICTVPage, ICTVAuthPage
+from ictv.plugin_manager.plugin_manager import get_logger
 from ictv.plugin_manager.plugin_utils import ChannelGate
-from ictv.plugins.rss.rss import feedparser_parse, get_content
+from ictv.plugins.rss.feed_cache import fetch_recent_feed
+from ictv.plugins.rss.rss import get_content
+from ictv.plugins.rss.timing import get_timing_summary
 from ictv.renderer.renderer import Templates
 
 import ictv.flask.response as resp
@@ -62,6 +65,7 @@ def get_app(ictv_app):
     app.add_url_rule('/feed', view_func=FeedGetter.as_view('FeedGetter'), methods=get_methods(FeedGetter))
     app.add_url_rule('/content', view_func=ContentPage.as_view('ContentPage'), methods=get_methods(ContentPage))
     app.add_url_rule('/preview', view_func=PreviewPage.as_view('PreviewPage'), methods=get_methods(PreviewPage))
+    app.add_url_rule('/timings', view_func=TimingsPage.as_view('TimingsPage'), methods=get_methods(TimingsPage))
 
     RssPage.plugin_app = app
 
@@ -109,15 +113,38 @@ class IndexPage(RssPage):
 class FeedGetter(RssPage):
     @ChannelGate.contributor
     def post(self, channel):
+        """
+        Streams the entries of the feed at the url given in the request body. The optional offset and limit query
+        parameters select a range of entries, the fields parameter a comma-separated list of entry keys to keep. The
+        entries are sent as a JSON array, or as newline-delimited JSON if the format parameter is ndjson.
+        """
         url = flask.request.get_data().decode()
-        if FeedGetter._is_url(url):
-            r = flask.Response(json.dumps(feedparser_parse(url).entries, cls=DateTimeEncoder))
-            r.headers["Content-Type"] = "application/json"
-            try:
-                return r
-            except TypeError:
-                return "Feed could not be parsed"
-        resp.notfound()
+        if not FeedGetter._is_url(url):
+            resp.notfound()
+        try:
+            offset = max(0, int(flask.request.args.get('offset', 0)))
+            limit = max(0, int(flask.request.args['limit'])) if 'limit' in flask.request.args else None
+        except ValueError:
+            resp.badrequest()
+        fields = [f for f in flask.request.args.get('fields', '').split(',') if f]
+
+        entries = fetch_recent_feed(url, logger=get_logger('rss', channel)).entries
+        entries = entries[offset:offset + limit] if limit is not None else entries[offset:]
+        if fields:
+            entries = [{k: entry[k] for k in fields if k in entry} for entry in entries]
+
+        if flask.request.args.get('format') == 'ndjson':
+            def generate():
+                for entry in entries:
+                    yield json.dumps(entry, cls=DateTimeEncoder) + '\n'
+            return flask.Response(generate(), mimetype='application/x-ndjson')
+
+        def generate():
+            yield '['
+            for i, entry in enumerate(entries):
+                yield (', ' if i > 0 else '') + json.dumps(entry, cls=DateTimeEncoder)
+            yield ']'
+        return flask.Response(generate(), mimetype='application/json')
 
     @staticmethod
     def _is_url(url):
@@ -125,6 +152,16 @@ class FeedGetter(RssPage):
         return o.scheme != '' or o.netloc != ''
 
 
+class TimingsPage(RssPage):
+    @ChannelGate.contributor
+    def get(self, channel):
+        """ Returns the timing summary of the refreshes of the channel made by this process, as JSON. """
+        summary = get_timing_summary(channel.id)
+        if summary is None:
+            resp.notfound()
+        return flask.Response(json.dumps(summary), mimetype='application/json')
+
+
 def post_process_config(config, channel):
     for k, v in list(config.items()):
         if k in channel.plugin.channels_params:
@@ -143,7 +180,7 @@ class ContentPage(RssPage):
 
         capsules = []
         try:
-            for c in get_content(channel.id, config):
+            for c in get_content(channel.id, config, preview=True):
                 slides = []
                 for s in c.get_slides():
                     slides.append(s.get_content())
@@ -159,7 +196,7 @@ class PreviewPage(RssPage):
         config = json.loads(self.form.config)
         post_process_config(config, channel)
         try:
-            content = get_content(channel.id, config)
+            content = get_content(channel.id, config, preview=True)
         except ValueError:
             resp.badrequest()
 
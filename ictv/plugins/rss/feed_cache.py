@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib.request
+import zlib
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlparse
+
+import feedparser
+
+from ictv.plugins.rss.storage import cache_dir
+from ictv.plugins.rss.timing import PipelineTimer
+
+feeds_dir = os.path.join(cache_dir, 'feeds')
+os.makedirs(feeds_dir, exist_ok=True)
+
+feed_timeout = 30  # in seconds
+recent_feed_max_age = 60  # in seconds
+max_recent_feeds = 64
+
+_states = {}  # url -> (mtime of the state file, FeedState)
+_states_lock = threading.Lock()
+_recent_feeds = {}  # url -> (time of the fetch, FeedState)
+
+
+class FeedState(object):
+    """ The last known copy of a feed, along with the validators needed to issue a conditional request for it. """
+    def __init__(self, url, entries=None, etag=None, modified=None, digest=None):
+        self.url = url
+        self.entries = entries if entries is not None else []
+        self.etag = etag
+        self.modified = modified
+        self.digest = digest
+
+    def to_json(self):
+        return {'url': self.url, 'entries': self.entries, 'etag': self.etag, 'modified': self.modified,
+                'digest': self.digest}
+
+    @classmethod
+    def from_json(cls, d):
+        return cls(d['url'], [restore_entry(e) for e in d['entries']], d.get('etag'), d.get('modified'), d.get('digest'))
+
+
+def fetch_feed(url, timer=None, persist=True, logger=None):
+    """
+    Returns the FeedState of the feed at the given url. When a copy of the feed is already known, a conditional
+    request is sent using its ETag and Last-Modified validators and the known entries are reused if the server
+    answers 304 Not Modified. The digest attribute of the returned state only changes when the entries do.
+    The time spent downloading and parsing the feed is added to the given PipelineTimer, if any. The new state is
+    only stored on disk if persist is True. If the feed cannot be downloaded, the failure is logged with the given
+    logger, if any, timed as a failed fetch and the known entries are returned.
+    """
+    timer = timer if timer is not None else PipelineTimer()
+    state = load_state(url)
+    if urlparse(url).scheme in ('http', 'https'):
+        start = time.perf_counter()
+        try:
+            data, headers = _download_feed(url, state)
+            timer.add('fetch', time.perf_counter() - start)
+        except (URLError, OSError, zlib.error) as e:
+            timer.add('failed fetch', time.perf_counter() - start)
+            if logger is not None:
+                logger.warning('Could not fetch feed %s, its last known entries are used: %s' % (url, str(e)))
+            data, headers = None, {}
+    else:  # A local file, left to feedparser
+        data, headers = url, {}
+
+    if data is not None:
+        with timer.stage('parse'):
+            result = feedparser_parse(data, response_headers=headers)
+            entries = json.loads(json.dumps(result['entries'], default=str))  # Normalizes the entries to what can be stored
+            new_state = FeedState(url, [restore_entry(e) for e in entries], headers.get('etag'),
+                                  headers.get('last-modified'), entries_digest(entries))
+        if persist and (new_state.digest != state.digest or new_state.etag != state.etag
+                        or new_state.modified != state.modified):
+            store_state(new_state)
+        state = new_state
+
+    now = time.time()
+    with _states_lock:
+        for recent_url, (fetch_time, _) in list(_recent_feeds.items()):
+            if now - fetch_time >= recent_feed_max_age:
+                del _recent_feeds[recent_url]
+        if len(_recent_feeds) < max_recent_feeds or url in _recent_feeds:
+            _recent_feeds[url] = (now, state)
+    return state
+
+
+def fetch_recent_feed(url, max_age=recent_feed_max_age, logger=None):
+    """
+    Returns the FeedState of the feed at the given url, reusing without any request a copy fetched recently. As any url
+    can be previewed, the state of a feed fetched here is only kept in memory and never stored on disk.
+    """
+    with _states_lock:
+        recent = _recent_feeds.get(url)
+    if recent and time.time() - recent[0] < max_age:
+        return recent[1]
+    return fetch_feed(url, persist=False, logger=logger)
+
+
+def _download_feed(url, state):
+    """
+    Downloads the feed at the given url. Returns its content and the lowercased response headers, or None as content
+    if the feed has not been modified since the given state was fetched, in which case the entries of the state are
+    kept. Any other failure to download or decompress the feed is raised.
+    """
+    request = urllib.request.Request(url, headers={'User-Agent': feedparser.USER_AGENT, 'Accept-Encoding': 'gzip, deflate'})
+    if state.etag:
+        request.add_header('If-None-Match', state.etag)
+    if state.modified:
+        request.add_header('If-Modified-Since', state.modified)
+    try:
+        with urllib.request.urlopen(request, timeout=feed_timeout) as response:
+            data = response.read()
+            headers = {k.lower(): v for k, v in response.headers.items()}
+            headers['content-location'] = response.geturl()  # Used by feedparser to resolve relative urls
+    except HTTPError as e:
+        if e.code == 304:  # Not Modified
+            return None, {}
+        raise
+
+    encoding = headers.pop('content-encoding', '')
+    if encoding == 'gzip':
+        data = gzip.decompress(data)
+    elif encoding == 'deflate':
+        data = zlib.decompress(data)
+    return data, headers
+
+
+def load_state(url):
+    """ Returns the last stored FeedState for the given url, or an empty state if none exists. """
+    path = _state_path(url)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return FeedState(url)
+    with _states_lock:
+        cached = _states.get(url)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    try:
+        with open(path, 'r') as f:
+            state = FeedState.from_json(json.load(f))
+    except (OSError, ValueError, KeyError):
+        return FeedState(url)
+    with _states_lock:
+        _states[url] = (mtime, state)
+    return state
+
+
+def store_state(state):
+    path = _state_path(state.url)
+    tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'w') as f:
+        json.dump(state.to_json(), f)
+    os.replace(tmp_path, path)
+    with _states_lock:
+        _states[state.url] = (os.path.getmtime(path), state)
+
+
+def entries_digest(entries):
+    return hashlib.md5(json.dumps(entries, sort_keys=True, ensure_ascii=True).encode()).hexdigest()
+
+
+def _state_path(url):
+    return os.path.join(feeds_dir, hashlib.md5(url.encode()).hexdigest() + '.json')
+
+
+def restore_entry(d):
+    """ Restores the FeedParserDict and time.struct_time objects of an entry loaded from JSON. """
+    if isinstance(d, dict):
+        restored = feedparser.FeedParserDict()
+        for k, v in d.items():
+            if k.endswith('_parsed') and isinstance(v, list) and len(v) == 9:
+                restored[k] = time.struct_time(v)
+            else:
+                restored[k] = restore_entry(v)
+        return restored
+    elif isinstance(d, list):
+        return [restore_entry(v) for v in d]
+    return d
+
+
+def feedparser_parse(uri, **kwargs):
+    try:
+        return feedparser.parse(uri, **kwargs)
+    except TypeError:
+        if 'drv_libxml2' in feedparser.PREFERRED_XML_PARSERS:
+            feedparser.PREFERRED_XML_PARSERS.remove('drv_libxml2')
+            return feedparser.parse(uri, **kwargs)
+        else:
+            raise
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from urllib.error import HTTPError
+
+from ictv.plugins.rss.storage import get_db
+
+link_page_timeout = 10  # in seconds, for each page
+max_workers = 8
+max_cache_size = 64 * 1024 * 1024  # in bytes, for all the pages of the cache
+max_page_size = 4 * 1024 * 1024  # in bytes, larger pages are not cached
+
+max_age_pattern = re.compile(r'max-age\s*=\s*"?(\d+)')
+
+_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='rss-link-pages')
+
+
+def fetch_link_page(url):
+    """
+    Returns the content of the page at the given url along with its final url, in case of redirect(s). The pages are
+    kept in a cache shared by all the channels, keyed by their final url. A cached page is returned without any
+    request while it is fresh according to its Cache-Control or Expires headers, and is revalidated using its ETag
+    and Last-Modified validators afterwards.
+    """
+    db = get_db()
+    now = time.time()
+    cached = db.execute('SELECT p.url, p.body, p.etag, p.last_modified, p.expires FROM link_page_redirects r '
+                        'JOIN link_pages p ON p.url = r.final_url WHERE r.url = ?', (url,)).fetchone()
+    if cached:
+        final_url, body, etag, last_modified, expires = cached
+        if now < expires:
+            _touch_page(final_url, now)
+            return body.decode(errors='ignore'), final_url
+
+    request = urllib.request.Request(url)
+    if cached and etag:
+        request.add_header('If-None-Match', etag)
+    if cached and last_modified:
+        request.add_header('If-Modified-Since', last_modified)
+    try:
+        with urllib.request.urlopen(request, timeout=link_page_timeout) as response:
+            body = response.read()
+            final_url = response.geturl()
+            headers = response.headers
+    except HTTPError as e:
+        if e.code != 304 or not cached:
+            raise
+        with db:
+            db.execute('UPDATE link_pages SET expires = ?, last_access = ? WHERE url = ?',
+                       (_get_expiration_time(e.headers, now) or now, now, final_url))
+        return body.decode(errors='ignore'), final_url
+
+    _store_page(url, final_url, body, headers, now)
+    return body.decode(errors='ignore'), final_url
+
+
+def prefetch_link_pages(urls):
+    """
+    Fetches concurrently the pages at the given urls. Returns a dict mapping each url to a tuple (page, final url) or
+    to the exception raised while fetching it.
+    """
+    futures = {url: _executor.submit(fetch_link_page, url) for url in set(urls)}
+    pages = {}
+    for url, future in futures.items():
+        try:
+            pages[url] = future.result()
+        except Exception as e:
+            pages[url] = e
+    return pages
+
+
+def _get_expiration_time(headers, now):
+    """ Returns the time until which a response can be used without revalidation, or None if it cannot be stored. """
+    cache_control = (headers.get('Cache-Control') or '').lower()
+    if 'no-store' in cache_control or 'private' in cache_control:
+        return None
+    if 'no-cache' in cache_control:
+        return now
+    max_age = max_age_pattern.search(cache_control)
+    if max_age:
+        return now + int(max_age.group(1))
+    if headers.get('Expires'):
+        try:
+            return max(now, parsedate_to_datetime(headers['Expires']).timestamp())
+        except (TypeError, ValueError):
+            return now
+    return now
+
+
+def _store_page(url, final_url, body, headers, now):
+    expires = _get_expiration_time(headers, now)
+    etag, last_modified = headers.get('ETag'), headers.get('Last-Modified')
+    if expires is None or len(body) > max_page_size or (expires <= now and not etag and not last_modified):
+        return  # This page cannot be reused later
+    db = get_db()
+    with db:
+        db.execute('INSERT OR REPLACE INTO link_pages (url, body, etag, last_modified, expires, size, last_access) '
+                   'VALUES (?, ?, ?, ?, ?, ?, ?)', (final_url, body, etag, last_modified, expires, len(body), now))
+        db.execute('INSERT OR REPLACE INTO link_page_redirects (url, final_url) VALUES (?, ?)', (url, final_url))
+        if final_url != url:
+            db.execute('INSERT OR REPLACE INTO link_page_redirects (url, final_url) VALUES (?, ?)', (final_url, final_url))
+        _evict_pages(db)
+
+
+def _touch_page(final_url, now):
+    db = get_db()
+    with db:
+        db.execute('UPDATE link_pages SET last_access = ? WHERE url = ?', (now, final_url))
+
+
+def _evict_pages(db):
+    """ Removes the least recently used pages until the cache fits in its maximum size. """
+    excess = db.execute('SELECT COALESCE(SUM(size), 0) FROM link_pages').fetchone()[0] - max_cache_size
+    if excess <= 0:
+        return
+    evicted = []
+    for page_url, size in db.execute('SELECT url, size FROM link_pages ORDER BY last_access'):
+        evicted.append((page_url,))
+        excess -= size
+        if excess <= 0:
+            break
+    db.executemany('DELETE FROM link_pages WHERE url = ?', evicted)
+    db.execute('DELETE FROM link_page_redirects WHERE final_url NOT IN (SELECT url FROM link_pages)')
+
+
+def get_link_page(pages, url):
+    """ Returns the prefetched page and final url for the given url, raising the exception encountered if any. """
+    page = pages[url]
+    if isinstance(page, Exception):
+        raise page
+    return page
@@ -19,39 +19,54 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
 
+import copy
 import json
 import os
-import re
-import urllib.request
-import urllib.response
+import time
 from datetime import datetime, timedelta
 from time import mktime
 
-import fcntl
 from urllib.parse import urljoin
 
-import feedparser
 import zlib
 
 from ictv.common import get_root_path
-from ictv.common.json_datetime import DateTimeDecoder, DateTimeEncoder
-from ictv.models.channel import Channel
+from ictv.models.channel import Channel, PluginChannel
+from ictv.models.plugin import Plugin
 from ictv.plugin_manager.plugin_capsule import PluginCapsule
 from ictv.plugin_manager.plugin_manager import get_logger, _is_url
 from ictv.plugin_manager.plugin_slide import PluginSlide
+from ictv.plugins.rss.feed_cache import fetch_feed, fetch_recent_feed, restore_entry
+from ictv.plugins.rss.link_pages import prefetch_link_pages, get_link_page
+from ictv.plugins.rss.rules import compile_rules, deep_get, get_value
+from ictv.plugins.rss.storage import get_entry_ages, record_entries, evict_entries, eviction_due, import_json_cache, \
+    touch_interval, cache_dir, default_cache_dir
+from ictv.plugins.rss.timing import PipelineTimer, report_timings
 
-this_group = 'this' # when searching for regular expression matches, we search
-                    # for a group named (?P<this>) in the regexp. If there is
-                    # such a group, we return the match of that group, if not,
-                    # we return the entire matching (if any).
+legacy_cache_path = os.path.join(os.path.dirname(__file__), 'cache.json')
+if cache_dir == default_cache_dir and os.path.exists(legacy_cache_path):  # Leaves it to the actual cache
+    import_json_cache(legacy_cache_path)
 
-cache_path = os.path.join(os.path.dirname(__file__), 'cache.json')
-if not os.path.exists(cache_path):
-    with open(cache_path, 'w') as f:
-        json.dump({}, f)
+preview_max_age = 30  # in seconds
+entry_retention = 90  # in days, the entries absent from all the feeds are remembered at least this long
 
+_last_content = {}  # channel_id -> (parameters hash, feed digest, expiration date, capsules)
+_preview_content = {}  # (url, config hash) -> (time of the preview, capsules)
+_last_recorded = {}  # channel_id -> time at which the entries of its feed were last recorded
 
-def get_content(channel_id, config=None):
+
+def get_content(channel_id, config=None, preview=False):
+    """
+    Returns the capsules of the channel built using its config or the given one. In preview mode, the feed is read
+    from a recently fetched copy, the entry ages are only read and the result is memoized for a short time, so that
+    previewing a config never modifies the state used to build the content of the channel.
+    """
+    if preview:
+        return _get_preview_content(channel_id, config)
+    return _build_content(channel_id, config)
+
+
+def _build_content(channel_id, config=None, preview=False):
     channel = Channel.get(channel_id)
     logger = get_logger('rss', channel)
     if not config:
@@ -70,81 +85,106 @@ def get_content(channel_id, config=None):
     template = get_param('template')
     theme = get_param('theme')
     min_age = datetime.now() - timedelta(days=time_limit)
+    timer = PipelineTimer()
 
-    entries = feedparser_parse(url)['entries'][:no_slides] if not config or not config.get('feed') else config.get('feed')
-    capsules = []
-    last_entries = []
-
-    with open(cache_path, 'r+') as f:
-        fcntl.flock(f, fcntl.LOCK_EX)
-        cache = json.load(f, cls=DateTimeDecoder)
+    if not config or not config.get('feed'):
+        feed = fetch_recent_feed(url, logger=logger) if preview else fetch_feed(url, timer, logger=logger)
+        entries = feed.entries[:no_slides]
+    else:
+        feed = None
+        entries = [restore_entry(entry) for entry in config.get('feed')]
 
-        for entry in entries:
-            if 'published_parsed' in entry:
-                entry_age = datetime.fromtimestamp(mktime(entry['published_parsed']))
-                if entry_age >= min_age:
-                    last_entries.append(entry)
-            else:
-                entry_hash = hash_dict(entry)
-                if entry_hash in cache:
-                    if cache[entry_hash] >= min_age:
-                        last_entries.append(entry)
-                else:
-                    cache[entry_hash] = datetime.now()
-        f.seek(0)
-        json.dump(cache, f, cls=DateTimeEncoder)
-        f.truncate()
-        fcntl.flock(f, fcntl.LOCK_UN)
+    if not config:
+        params_hash = hash_dict([url, parser_rules, additional_rules, filter, exception_rules, no_slides, time_limit,
+                                 duration, template, theme])
+        last_content = _last_content.get(channel_id)
+        if last_content and last_content[:2] == (params_hash, feed.digest) and datetime.now() < last_content[2]:
+            # The feed and the channel config did not change since the last time and no entry became too old
+            logger.debug('Feed %s has not changed, reusing the previous content' % url)
+            if time.time() - _last_recorded.get(channel_id, 0) >= touch_interval:
+                # Keeps the entries still in the feed from being evicted
+                with timer.stage('cache I/O'):
+                    record_entries(h for h in (hash_dict(e) for e in entries if 'published_parsed' not in e))
+                _last_recorded[channel_id] = time.time()
+            report_timings(channel, logger, timer)
+            return copy.deepcopy(last_content[3])
 
+    capsules = []
+    last_entries = []
+    expiration_date = datetime.max
+
+    entry_hashes = [hash_dict(entry) if 'published_parsed' not in entry else None for entry in entries]
+    with timer.stage('cache I/O'):
+        entry_ages = get_entry_ages(h for h in entry_hashes if h)
+    for entry, entry_hash in zip(entries, entry_hashes):
+        if 'published_parsed' in entry:
+            entry_age = datetime.fromtimestamp(mktime(entry['published_parsed']))
+            if entry_age >= min_age:
+                last_entries.append(entry)
+                expiration_date = min(expiration_date, entry_age + timedelta(days=time_limit))
+        elif entry_hash in entry_ages:
+            if entry_ages[entry_hash] >= min_age:
+                last_entries.append(entry)
+                expiration_date = min(expiration_date, entry_ages[entry_hash] + timedelta(days=time_limit))
+        elif preview:
+            last_entries.append(entry)  # This entry would be seen for the first time
+        else:
+            expiration_date = datetime.now()  # This entry will be considered on the next refresh
+    if not preview:
+        start = time.perf_counter()
+        lock_wait = record_entries(h for h in entry_hashes if h)
+        if not config:
+            _last_recorded[channel_id] = time.time()
+        if eviction_due():
+            evict_entries(datetime.now() - get_entry_retention())
+        timer.add('lock wait', lock_wait)
+        timer.add('cache I/O', time.perf_counter() - start - lock_wait)
+
+    program = compile_rules(tuple(parser_rules), tuple(additional_rules), tuple(exception_rules)) if last_entries else None
+    with timer.stage('page fetches'):
+        link_pages = prefetch_link_pages(entry.link for entry in last_entries) if program and program.uses_link_page else {}
+
+    loop_start = time.perf_counter()
     for entry in last_entries:
         slide_content = {}
-        link_page = None
-        for slide_element, entry_item, regexp in [rule.split(';') for rule in parser_rules]:
-            field, input_type = slide_element.split(':')
-            if field not in slide_content:
-                slide_content[field] = {}
-
-            if entry_item == 'link_page':
-                if not link_page:
-                    with urllib.request.urlopen(entry.link) as response:
-                        link_page = response.read().decode(errors='ignore')
-                        entry_item += "@" + response.geturl() # in case of redirect(s), geturl() returns the final url of the page
-                item = link_page
+        for rule in program.parser_rules:
+            if rule.field not in slide_content:
+                slide_content[rule.field] = {}
+
+            rule_start = time.perf_counter()
+            ref_url = entry.link
+            if rule.entry_item == 'link_page':
+                item, ref_url = get_link_page(link_pages, entry.link)  # The final url of the page after redirect(s)
             else:
-                item = deep_get(entry, *entry_item.split('.'))
+                item = deep_get(entry, rule.path)
 
-            value = get_value(item, regexp)
-            if input_type == 'src' and not _is_url(value):
-                ref_url = entry.link
-                if entry_item.startswith('link_page@'):
-                    ref_url = entry_item.split('@')[1]
+            value = get_value(item, rule.pattern)
+            if rule.input_type == 'src' and not _is_url(value):
                 value = urljoin(ref_url, value)
+            timer.add_rule(rule.source, time.perf_counter() - rule_start)
 
-            slide_content[field].update({input_type: value})
+            slide_content[rule.field].update({rule.input_type: value})
 
-        for slide_element, string in [rule.split(';') for rule in additional_rules]:
-            field, input_type = slide_element.split(':')
-            if field not in slide_content:
-                slide_content[field] = {}
-            if string.lower() == 'qrcode':
-                input_type = 'qrcode'
-                string = entry.link
-            slide_content[field].update({input_type: string})
+        for rule in program.additional_rules:
+            if rule.field not in slide_content:
+                slide_content[rule.field] = {}
+            if rule.string.lower() == 'qrcode':
+                slide_content[rule.field].update({'qrcode': entry.link})
+            else:
+                slide_content[rule.field].update({rule.input_type: rule.string})
 
-        if len(exception_rules) == 1 and not exception_rules[0].strip():
+        if program.no_exception_rules:
             capsules.append(RssCapsule(theme=theme, slides=[RssSlide(content=slide_content, template=template, duration=duration)]))
         else:
-            for entry_item, regexp in [rule.split(';') for rule in exception_rules]:
-                if entry_item == 'link_page':
-                    if not link_page:
-                        with urllib.request.urlopen(entry.link) as response:
-                            link_page = response.read().decode(errors='ignore')
-                            entry_item += "@" + response.geturl() # in case of redirect(s), geturl() returns the final url of the page
-                    item = link_page
+            for rule in program.exception_rules:
+                rule_start = time.perf_counter()
+                if rule.entry_item == 'link_page':
+                    item, _ = get_link_page(link_pages, entry.link)
                 else:
-                    item = deep_get(entry, *entry_item.split('.'))
+                    item = deep_get(entry, rule.path)
 
-                value = get_value(item, regexp)
+                value = get_value(item, rule.pattern)
+                timer.add_rule(rule.source, time.perf_counter() - rule_start)
 
                 if filter and value is None:
                     capsules.append(RssCapsule(theme=theme, slides=[RssSlide(content=slide_content, template=template, duration=duration)]))
@@ -152,34 +192,36 @@ def get_content(channel_id, config=None):
                 if not filter and value is not None:
                     capsules.append(RssCapsule(theme=theme, slides=[RssSlide(content=slide_content, template=template, duration=duration)]))
 
+    rules_time = sum(timer.rules.values())
+    timer.add('rule evaluation', rules_time)
+    timer.add('capsule construction', time.perf_counter() - loop_start - rules_time)
+
+    if not config:
+        _last_content[channel_id] = (params_hash, feed.digest, expiration_date, copy.deepcopy(capsules))
+    if not preview:  # The previews would skew the timings of the channel
+        report_timings(channel, logger, timer)
     return capsules
 
 
-def get_value(item, regexp):
-    pattern = re.compile(regexp, re.DOTALL | re.MULTILINE)
-    match = pattern.search(item)
-    if match:
-        if this_group in pattern.groupindex:
-            return match.group(this_group)
-        else:
-            return match.group()
-    return None
-
-# pattern corresponding to access to list item inside XML elem tree
-gr_list_name = "name"
-gr_list_index = "index"
-list_regexp = r"(?P<" + gr_list_name+ ">[^[]+)\[(?P<" + gr_list_index + ">[0-9]+)\]"
-list_pattern = re.compile(list_regexp, re.DOTALL | re.MULTILINE)
-def deep_get(d, *keys):
-    for key in keys:
-        list_match = list_pattern.search(key)
-        if list_match:
-            name = list_match.group(gr_list_name)
-            index = int(list_match.group(gr_list_index))
-            d = d[name][index]
-        else:
-            d = d[key]
-    return d
+def get_entry_retention():
+    """
+    Returns how long the entries absent from all the feeds are remembered, i.e. the largest time limit of the RSS
+    channels, but at least entry_retention days.
+    """
+    time_limits = [c.get_config_param('time_limit') or 0
+                   for c in PluginChannel.selectBy(plugin=Plugin.selectBy(name='rss').getOne())]
+    return timedelta(days=max([entry_retention] + time_limits))
+
+
+def _get_preview_content(channel_id, config):
+    key = (config['url'], hash_dict(config))
+    now = time.time()
+    for k, (preview_time, _) in list(_preview_content.items()):
+        if now - preview_time >= preview_max_age:
+            _preview_content.pop(k, None)
+    if key not in _preview_content:
+        _preview_content[key] = (now, _build_content(channel_id, config, preview=True))
+    return copy.deepcopy(_preview_content[key][1])
 
 
 def hash_dict(d):
@@ -212,14 +254,3 @@ class RssCapsule(PluginCapsule):
 
     def get_theme(self) -> str:
         return self.theme
-
-
-def feedparser_parse(uri):
-    try:
-        return feedparser.parse(uri)
-    except TypeError:
-        if 'drv_libxml2' in feedparser.PREFERRED_XML_PARSERS:
-            feedparser.PREFERRED_XML_PARSERS.remove('drv_libxml2')
-            return feedparser.parse(uri)
-        else:
-            raise
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+this_group = 'this' # when searching for regular expression matches, we search
+                    # for a group named (?P<this>) in the regexp. If there is
+                    # such a group, we return the match of that group, if not,
+                    # we return the entire matching (if any).
+
+# pattern corresponding to access to list item inside XML elem tree
+gr_list_name = "name"
+gr_list_index = "index"
+list_regexp = r"(?P<" + gr_list_name+ ">[^[]+)\[(?P<" + gr_list_index + ">[0-9]+)\]"
+list_pattern = re.compile(list_regexp, re.DOTALL | re.MULTILINE)
+
+ParserRule = namedtuple('ParserRule', ['source', 'field', 'input_type', 'entry_item', 'path', 'pattern'])
+StaticRule = namedtuple('StaticRule', ['source', 'field', 'input_type', 'string'])
+ExceptionRule = namedtuple('ExceptionRule', ['source', 'entry_item', 'path', 'pattern'])
+
+
+class RuleProgram(object):
+    """ The rules of a channel, split and compiled once so that applying them to an entry only costs the matches. """
+    def __init__(self, parser_rules, additional_rules, exception_rules):
+        self.parser_rules = []
+        for rule in parser_rules:
+            slide_element, entry_item, regexp = rule.split(';')
+            field, input_type = slide_element.split(':')
+            self.parser_rules.append(ParserRule(rule, field, input_type, entry_item, compile_path(entry_item), compile_regexp(regexp)))
+
+        self.additional_rules = []
+        for rule in additional_rules:
+            slide_element, string = rule.split(';')
+            field, input_type = slide_element.split(':')
+            self.additional_rules.append(StaticRule(rule, field, input_type, string))
+
+        self.exception_rules = []
+        self.no_exception_rules = len(exception_rules) == 1 and not exception_rules[0].strip()
+        if not self.no_exception_rules:
+            for rule in exception_rules:
+                entry_item, regexp = rule.split(';')
+                self.exception_rules.append(ExceptionRule(rule, entry_item, compile_path(entry_item), compile_regexp(regexp)))
+
+        self.uses_link_page = any(r.entry_item == 'link_page' for r in self.parser_rules + self.exception_rules)
+
+
+@lru_cache(maxsize=256)
+def compile_rules(parser_rules, additional_rules, exception_rules):
+    """
+    Returns the RuleProgram of the given rules. The rules must be given as tuples, the programs are cached using them
+    as key so that a change in the channel config leads to a new program.
+    """
+    return RuleProgram(parser_rules, additional_rules, exception_rules)
+
+
+@lru_cache(maxsize=1024)
+def compile_regexp(regexp):
+    return re.compile(regexp, re.DOTALL | re.MULTILINE)
+
+
+def compile_path(entry_item):
+    """ Parses a path of the form key.list_key[index].key into a tuple of (key, index or None) pairs. """
+    path = []
+    for key in entry_item.split('.'):
+        list_match = list_pattern.search(key)
+        if list_match:
+            path.append((list_match.group(gr_list_name), int(list_match.group(gr_list_index))))
+        else:
+            path.append((key, None))
+    return tuple(path)
+
+
+def get_value(item, pattern):
+    match = pattern.search(item)
+    if match:
+        if this_group in pattern.groupindex:
+            return match.group(this_group)
+        else:
+            return match.group()
+    return None
+
+
+def deep_get(d, path):
+    for key, index in path:
+        d = d[key]
+        if index is not None:
+            d = d[index]
+    return d
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from ictv.common.json_datetime import DateTimeDecoder
+
+default_cache_dir = os.path.join(os.path.dirname(__file__), 'cache')
+cache_dir = os.environ.get('ICTV_RSS_CACHE_DIR', default_cache_dir)  # Must be set before the plugin is imported
+os.makedirs(cache_dir, exist_ok=True)
+db_path = os.path.join(cache_dir, 'cache.sqlite')
+
+eviction_interval = 60 * 60  # The entries are evicted at most once per hour and per process
+touch_interval = 60 * 60  # The last sighting of an entry is refreshed at most once per hour
+
+_local = threading.local()
+_last_eviction = 0
+
+
+def get_db():
+    """ Returns the SQLite connection of the current thread to the RSS plugin cache database. """
+    db = getattr(_local, 'db', None)
+    if db is None:
+        db = sqlite3.connect(db_path, timeout=30)
+        db.execute('PRAGMA journal_mode=WAL')  # Readers never wait for writers
+        db.execute('PRAGMA synchronous=NORMAL')
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS entry_ages (hash TEXT PRIMARY KEY, first_seen REAL NOT NULL, '
+                       'last_seen REAL NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS entry_ages_last_seen ON entry_ages (last_seen)')
+            db.execute('CREATE TABLE IF NOT EXISTS link_pages (url TEXT PRIMARY KEY, body BLOB NOT NULL, etag TEXT, '
+                       'last_modified TEXT, expires REAL NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS link_pages_last_access ON link_pages (last_access)')
+            db.execute('CREATE TABLE IF NOT EXISTS link_page_redirects (url TEXT PRIMARY KEY, final_url TEXT NOT NULL)')
+        _local.db = db
+    return db
+
+
+def get_entry_ages(hashes):
+    """ Returns a dict mapping the given entry hashes that are known to the date they were seen for the first time. """
+    db = get_db()
+    hashes = list(hashes)
+    ages = {}
+    for i in range(0, len(hashes), 500):
+        chunk = hashes[i:i + 500]
+        query = 'SELECT hash, first_seen FROM entry_ages WHERE hash IN (%s)' % ','.join('?' * len(chunk))
+        for entry_hash, first_seen in db.execute(query, chunk):
+            ages[entry_hash] = datetime.fromtimestamp(first_seen)
+    return ages
+
+
+def record_entries(hashes):
+    """
+    Records the first sighting of the new entry hashes and refreshes the last sighting of the known ones. Returns the
+    time spent waiting for the database write lock.
+    """
+    now = time.time()
+    db = get_db()
+    with db:
+        start = time.perf_counter()
+        db.execute('BEGIN IMMEDIATE')
+        lock_wait = time.perf_counter() - start
+        db.executemany('INSERT INTO entry_ages (hash, first_seen, last_seen) VALUES (?, ?, ?) '
+                       'ON CONFLICT (hash) DO UPDATE SET last_seen = excluded.last_seen '
+                       'WHERE last_seen < excluded.last_seen - %d' % touch_interval,
+                       [(entry_hash, now, now) for entry_hash in hashes])
+    return lock_wait
+
+
+def eviction_due():
+    """ Returns whether the entries should be evicted, which happens at most once per eviction_interval. """
+    return time.time() - _last_eviction >= eviction_interval
+
+
+def evict_entries(min_age):
+    """
+    Removes the entries that have not been seen in any feed since the given date. As the table is shared by all the
+    channels, the date must not depend on the time limit of a single channel.
+    """
+    global _last_eviction
+    _last_eviction = time.time()
+    db = get_db()
+    with db:
+        db.execute('DELETE FROM entry_ages WHERE last_seen < ?', (min_age.timestamp(),))
+
+
+def import_json_cache(path):
+    """ Imports the entries of the former cache.json file in the database and removes it. """
+    try:
+        with open(path, 'r') as f:
+            cache = json.load(f, cls=DateTimeDecoder)
+        os.remove(path)
+    except (OSError, ValueError):
+        return
+    now = time.time()
+    db = get_db()
+    with db:
+        db.executemany('INSERT OR IGNORE INTO entry_ages (hash, first_seen, last_seen) VALUES (?, ?, ?)',
+                       [(entry_hash, first_seen.timestamp(), now) for entry_hash, first_seen in cache.items()])
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+#    This file belongs to the ICTV project, written by Nicolas Detienne,
+#    Francois Michel, Maxime Piraux, Pierre Reinbold and Ludovic Taffin
+#    at Université catholique de Louvain.
+#
+#    Copyright (C) 2016-2018  Université catholique de Louvain (UCL, Belgium)
+#
+#    ICTV is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ICTV is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with ICTV.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+slow_refresh_threshold = 5  # in seconds, slower refreshes are logged as warnings
+summary_log_interval = 100  # The timing summary of a channel is logged every this many refreshes
+
+metrics_hooks = []  # Callables receiving the channel id, the stage timings and the rule timings of each refresh
+
+_summaries = {}
+_summaries_lock = threading.Lock()
+
+
+class PipelineTimer(object):
+    """ Measures the time spent in each stage of the content pipeline of a channel, and in each of its rules. """
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.rules = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, duration):
+        self.stages[name] = self.stages.get(name, 0) + duration
+
+    def add_rule(self, rule, duration):
+        self.rules[rule] = self.rules.get(rule, 0) + duration
+
+    @property
+    def total(self):
+        return sum(self.stages.values())
+
+
+class TimingSummary(object):
+    """ Aggregates the timings of the refreshes of a channel. """
+    def __init__(self):
+        self.refreshes = 0
+        self.total = 0
+        self.max_total = 0
+        self.stages = {}
+        self.rules = {}
+
+    def add(self, timer):
+        self.refreshes += 1
+        self.total += timer.total
+        self.max_total = max(self.max_total, timer.total)
+        for name, duration in timer.stages.items():
+            self.stages[name] = self.stages.get(name, 0) + duration
+        for rule, duration in timer.rules.items():
+            self.rules[rule] = self.rules.get(rule, 0) + duration
+
+    def to_dict(self):
+        def mean(d):
+            return {k: v / self.refreshes for k, v in sorted(d.items(), key=lambda x: x[1], reverse=True)}
+        return {'refreshes': self.refreshes, 'mean': self.total / self.refreshes, 'max': self.max_total,
+                'stages': mean(self.stages), 'rules': mean(self.rules)}
+
+
+def add_metrics_hook(hook):
+    metrics_hooks.append(hook)
+
+
+def report_timings(channel, logger, timer):
+    """ Logs the timings of a refresh of the channel, adds them to its summary and passes them to the metrics hooks. """
+    logger_extra = {'channel_name': channel.name, 'channel_id': channel.id, 'timings': dict(timer.stages)}
+    with _summaries_lock:
+        summary = _summaries.setdefault(channel.id, TimingSummary())
+        summary.add(timer)
+        summary_dict = summary.to_dict() if summary.refreshes % summary_log_interval == 0 else None
+
+    description = ', '.join('%s: %.3fs' % (name, duration) for name, duration in timer.stages.items())
+    if timer.total >= slow_refresh_threshold:
+        slowest_stage = max(timer.stages, key=timer.stages.get)
+        message = 'Slow refresh of %.3fs, mostly spent in %s (%s)' % (timer.total, slowest_stage, description)
+        if timer.rules:
+            slowest_rule = max(timer.rules, key=timer.rules.get)
+            message += ', slowest rule is %s (%.3fs)' % (slowest_rule, timer.rules[slowest_rule])
+        logger.warning(message, extra=logger_extra)
+    else:
+        logger.debug('Refreshed in %.3fs (%s)' % (timer.total, description), extra=logger_extra)
+
+    if summary_dict is not None:
+        logger.info('Timing summary of %d refreshes: mean %.3fs, max %.3fs, stages %s' % (
+            summary_dict['refreshes'], summary_dict['mean'], summary_dict['max'],
+            ', '.join('%s: %.3fs' % (name, duration) for name, duration in summary_dict['stages'].items())),
+            extra=dict(logger_extra, summary=summary_dict))
+
+    for hook in metrics_hooks:
+        try:
+            hook(channel.id, dict(timer.stages), dict(timer.rules))
+        except Exception:
+            logger.warning('A metrics hook raised an exception', extra=logger_extra, exc_info=True)
+
+
+def get_timing_summary(channel_id=None):
+    """
+    Returns the timing summary of the given channel, or of all the channels sorted from the slowest to the fastest.
+    Each summary contains the mean and max durations of a refresh and the mean duration of each stage and rule.
+    """
+    with _summaries_lock:
+        if channel_id is not None:
+            return _summaries[channel_id].to_dict() if channel_id in _summaries else None
+        summaries = {k: v.to_dict() for k, v in _summaries.items()}
+    return OrderedDict(sorted(summaries.items(), key=lambda x: x[1]['mean'], reverse=True))
@@ -1,5 +1,7 @@
+import io
 import json
 from datetime import datetime, timedelta
+from unittest import mock
 
 from ictv.models.channel import PluginChannel
 from ictv.models.plugin import Plugin
@@ -148,3 +150,108 @@ class SlideTest(EditorAPITest):
         self.testApp.get('/channels/{}/api/capsules/1/slides/1'.format(self.channel.id), status=200, headers={'X-ICTV-editor-API-Key': 'aaaaaaaa'})
         self.testApp.delete('/channels/{}/api/capsules/1/slides/1'.format(self.channel.id), status=204, headers={'X-ICTV-editor-API-Key': 'aaaaaaaa'})
         self.testApp.get('/channels/{}/api/capsules/1/slides/1'.format(self.channel.id), status=404, headers={'X-ICTV-editor-API-Key': 'aaaaaaaa'})
+
+
+class ContentTest(EditorAPITest):
+    def runTest(self):
+        """ Tests the content of the channel as displayed on the screens. """
+        from ictv.plugins.editor.editor import get_content, get_content_version
+        now = datetime.now()
+        c1 = EditorCapsule(name='Second', channel=self.channel, c_order=1, theme='ictv',
+                           validity_from=now - timedelta(hours=1), validity_to=now + timedelta(hours=1))
+        c2 = EditorCapsule(name='First', channel=self.channel, c_order=0, theme='ictv',
+                           validity_from=now - timedelta(hours=1), validity_to=now + timedelta(hours=1))
+        EditorCapsule(name='Empty', channel=self.channel, c_order=2, theme='ictv',
+                      validity_from=now - timedelta(hours=1), validity_to=now + timedelta(hours=1))
+        EditorCapsule(name='Expired', channel=self.channel, c_order=3, theme='ictv',
+                      validity_from=now - timedelta(hours=2), validity_to=now - timedelta(hours=1))
+        EditorSlide(duration=-1, content={'title-1': {'text': '1.2'}}, s_order=1, template='template-text-center', capsule=c1)
+        EditorSlide(duration=3000, content={'title-1': {'text': '1.1'}}, s_order=0, template='template-text-center', capsule=c1)
+        EditorSlide(duration=4000, content={'title-1': {'text': '2.1'}}, s_order=0, template='template-text-center', capsule=c2)
+
+        content = get_content(self.channel.id)
+        assert [[s.get_content()['title-1']['text'] for s in c.get_slides()] for c in content] == [['2.1'], ['1.1', '1.2'], []]
+        default_duration = int(self.channel.get_config_param('duration') * 1000)
+        assert [s.get_duration() for s in content[1].get_slides()] == [3000, default_duration]
+
+        self.channel.plugin_config['force_duration'] = True
+        self.channel.plugin_config = self.channel.plugin_config
+        content = get_content(self.channel.id, capsuleid=c1.id)
+        assert len(content) == 1
+        assert [s.get_duration() for s in content[0].get_slides()] == [default_duration, default_duration]
+
+        version = get_content_version(self.channel.id)
+        assert get_content_version(self.channel.id) == version
+        get_content(self.channel.id)[0].get_slides()[0].get_content()['title-1']['text'] = 'Modified by the caller'
+        assert get_content(self.channel.id)[0].get_slides()[0].get_content()['title-1']['text'] == '2.1'
+        s3 = EditorSlide(duration=4000, content={'title-1': {'text': '2.2'}}, s_order=1, template='template-text-center', capsule=c2)
+        assert get_content_version(self.channel.id) > version
+        assert [s.get_content()['title-1']['text'] for s in get_content(self.channel.id)[0].get_slides()] == ['2.1', '2.2']
+
+        # The processes serving the channel share its version and the invalidations of its content
+        from ictv.plugins.editor import editor
+        version = get_content_version(self.channel.id)
+        editor._content_cache.clear()
+        assert get_content_version(self.channel.id) == version
+        connection = EditorSlide._connection
+        connection.query("UPDATE %s SET template = 'template-text-left' WHERE id = %d" % (EditorSlide.sqlmeta.table, s3.id))
+        assert get_content(self.channel.id)[0].get_slides()[1].get_template() == 'template-text-center'
+        editor.invalidate_content(self.channel.id)  # As done by the process that changed the slide
+        assert get_content(self.channel.id)[0].get_slides()[1].get_template() == 'template-text-left'
+        assert get_content_version(self.channel.id) > version
+
+
+class OrderTest(EditorAPITest):
+    def runTest(self):
+        """ Tests that moving a capsule or a slide only updates its own order key. """
+        from ictv.plugins.editor.editor import order_gap
+        now = datetime.now()
+        capsules = [EditorCapsule(name='Capsule %d' % i, channel=self.channel, c_order=EditorCapsule.get_next_c_order(self.channel.id),
+                                  theme='ictv', validity_from=now, validity_to=now + timedelta(hours=1)) for i in range(5)]
+        assert [c.c_order for c in capsules] == [i * order_gap for i in range(5)]
+        new_order = [capsules[0], capsules[3], capsules[1], capsules[2], capsules[4]]
+        EditorCapsule.reorder(self.channel.id, [c.id for c in new_order])
+        assert list(EditorCapsule.rectify_c_order(self.channel.id)) == new_order
+        assert [c.c_order for c in capsules if c is not capsules[3]] == [0, order_gap, 2 * order_gap, 4 * order_gap]
+
+        slides = [EditorSlide(duration=-1, s_order=EditorSlide.get_next_s_order(capsules[0].id), template='template-text-center',
+                              capsule=capsules[0]) for _ in range(3)]
+        duplicate = slides[0].duplicate(s_order=-1)
+        capsules[0].insert_slide_at(duplicate, 1)
+        assert EditorSlide.rectify_s_order(capsules[0].id) == [slides[0], duplicate, slides[1], slides[2]]
+        assert [s.s_order for s in slides] == [0, order_gap, 2 * order_gap]
+
+
+class VideoUploadTest(EditorAPITest):
+    def runTest(self):
+        """ Tests that a WebM video uploaded twice to a channel is only stored once, and the table of the video digests. """
+        from ictv.models.asset import Asset
+        from ictv.models.user import User
+        from ictv.plugins.editor.editor import VideoDigest, update
+        from ictv.storage.storage_manager import StorageManager
+        now = datetime.now()
+        capsule = EditorCapsule(name='Videos', channel=self.channel, c_order=0, theme='ictv', validity_from=now,
+                                validity_to=now + timedelta(hours=1))
+        user = User(email='editor-video@localhost', disabled=False)
+        storage_manager = StorageManager(self.channel.id)
+
+        def upload():
+            video = io.BytesIO(b'\x1a\x45\xdf\xa3' + bytes(range(256)) * 64)
+            video.filename = 'video.webm'
+            with mock.patch('ictv.plugins.editor.editor.magic.from_buffer', return_value='video/webm'):
+                return EditorSlide.from_video(video, storage_manager, None, capsule, user.id, 'black')
+
+        first = upload()
+        assets = Asset.select().count()
+        second = upload()
+        assert Asset.select().count() == assets  # The second upload was destroyed
+        assert second.content['background-1']['file'] == first.content['background-1']['file']
+        assert VideoDigest.selectBy(channel=self.channel).count() == 1
+        assert capsule.slides.count() == 2
+
+        plugin = Plugin.selectBy(name='editor').getOne()
+        VideoDigest.dropTable()
+        plugin.version = 1
+        update(plugin)
+        assert VideoDigest.tableExists()
+        assert plugin.version == 3
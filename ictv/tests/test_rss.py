@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from ictv.models.channel import PluginChannel
+from ictv.models.plugin import Plugin
+from ictv.tests import ICTVTestCase
+
+feed = """<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0">
+  <channel>
+    <title>Test feed</title>
+    <link>http://localhost/</link>
+    <description>A feed whose entry has no publication date</description>
+    <item>
+      <title>An undated entry</title>
+      <link>http://localhost/entry</link>
+    </item>
+  </channel>
+</rss>
+"""
+
+
+class RssStorageTest(ICTVTestCase):
+    def setUp(self):
+        super(RssStorageTest, self).setUp()
+        from ictv.plugins.rss import feed_cache, storage
+        self.feed_cache, self.storage = feed_cache, storage
+        self.cache_dir = tempfile.mkdtemp()
+        self.db_path, self.feeds_dir = storage.db_path, feed_cache.feeds_dir
+        storage.db_path = os.path.join(self.cache_dir, 'cache.sqlite')
+        storage._local = threading.local()  # Drops any connection to the previous database
+        feed_cache.feeds_dir = self.cache_dir
+
+    def tearDown(self):
+        self.storage.db_path, self.feed_cache.feeds_dir = self.db_path, self.feeds_dir
+        self.storage._local = threading.local()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        super(RssStorageTest, self).tearDown()
+
+    def create_channel(self, name, **config):
+        return PluginChannel(plugin=Plugin.selectBy(name='rss').getOne(), name=name, subscription_right='public',
+                             plugin_config=config)
+
+    def age_entries(self, days):
+        db = self.storage.get_db()
+        with db:
+            db.execute('UPDATE entry_ages SET last_seen = last_seen - ?', (days * 24 * 60 * 60,))
+
+    def get_last_seen(self):
+        return [last_seen for last_seen, in self.storage.get_db().execute('SELECT last_seen FROM entry_ages')]
+
+
+class EvictionTest(RssStorageTest):
+    def runTest(self):
+        """ Tests that the entries are evicted against the largest time limit of the RSS channels. """
+        from ictv.plugins.rss.rss import entry_retention, get_entry_retention
+        self.create_channel('Long time limit', time_limit=entry_retention + 30)
+        self.create_channel('Short time limit', time_limit=1)
+        assert get_entry_retention() == timedelta(days=entry_retention + 30)
+
+        self.storage.record_entries(['old'])
+        self.age_entries(entry_retention + 60)
+        self.storage.record_entries(['recent'])
+        self.age_entries(entry_retention)
+        self.storage.evict_entries(datetime.now() - get_entry_retention())
+        assert set(self.storage.get_entry_ages(['old', 'recent'])) == {'recent'}
+
+
+class UnchangedFeedTest(RssStorageTest):
+    def runTest(self):
+        """ Tests that the entries of a feed that did not change are still marked as seen. """
+        from ictv.plugins.rss import rss
+        feed_path = os.path.join(self.cache_dir, 'feed.xml')
+        with open(feed_path, 'w') as f:
+            f.write(feed)
+        channel = self.create_channel('Unchanged feed', url=feed_path, template='template-text-center',
+                                      parser_rules=['title-1:text;title;(.*)'], additional_rules=[], time_limit=30)
+
+        assert rss.get_content(channel.id) == []  # The entry is only shown from the refresh following its first sighting
+        assert len(rss.get_content(channel.id)) == 1
+        assert len(self.get_last_seen()) == 1
+        self.age_entries(10)
+        rss._last_recorded.pop(channel.id, None)
+        assert len(rss.get_content(channel.id)) == 1  # Reuses the previous content, as the feed did not change
+        assert all(time.time() - last_seen < 60 for last_seen in self.get_last_seen())
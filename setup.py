@@ -14,6 +14,6 @@ setup(
     author='Michel François, Piraux Maxime, Taffin Ludovic, Nicolas Detienne, Pierre Reinbold',
     author_email='',
     description='ICTV is a simple content management system for digital signage on multiple screens.',
-    install_requires=['pyquery', 'BeautifulSoup4', 'feedparser'],
+    install_requires=['pyquery', 'lxml', 'feedparser'],
     include_package_data=True,
 )